@@ -1,7 +1,7 @@
 import express from 'express';
 import cors from 'cors';
 
-import { nlpChat } from './nlpClient.js';
+import { nlpChat, nlpChatStream } from './nlpClient.js';
 import {
   appendMessage,
   createConversation,
@@ -112,6 +112,54 @@ app.post('/api/chat', async (req, res) => {
   }
 });
 
+// Same as /api/chat, relayed as server-sent events (meta, delta..., done) from the NLP service.
+app.post('/api/chat/stream', async (req, res) => {
+  const { message, conversationId, language } = req.body as {
+    message?: string;
+    conversationId?: string;
+    language?: 'ar' | 'en' | 'fr';
+  };
+
+  if (!message || !conversationId) {
+    return res.status(400).json({ error: 'message and conversationId are required' });
+  }
+
+  ensureConversation(conversationId);
+  appendMessage({
+    id: genId(),
+    conversationId,
+    role: 'user',
+    content: message,
+    timestamp: new Date(),
+  });
+
+  res.status(200);
+  res.setHeader('Content-Type', 'text/event-stream');
+  res.setHeader('Cache-Control', 'no-cache');
+  res.setHeader('X-Accel-Buffering', 'no');
+  res.flushHeaders();
+
+  try {
+    for await (const ev of nlpChatStream({ message, conversationId, language: language || 'en' })) {
+      res.write(`event: ${ev.event}\ndata: ${JSON.stringify(ev.data)}\n\n`);
+      if (ev.event === 'done') {
+        appendMessage({
+          id: genId(),
+          conversationId,
+          role: 'assistant',
+          content: ev.data.answer,
+          timestamp: new Date(),
+          sources: ev.data.sources,
+          explain: ev.data.explain,
+        });
+      }
+    }
+  } catch (e: any) {
+    res.write(`event: error\ndata: ${JSON.stringify({ error: String(e?.message || e) })}\n\n`);
+  }
+  return res.end();
+});
+
 app.listen(PORT, () => {
   // eslint-disable-next-line no-console
   console.log(`Backend API listening on http://localhost:${PORT}/api`);
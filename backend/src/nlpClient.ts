@@ -15,12 +15,22 @@ export interface NlpChatResponse {
   };
 }
 
-export async function nlpChat(params: {
+export interface NlpChatParams {
   message: string;
   conversationId: string;
   language: 'ar' | 'en' | 'fr';
-}): Promise<NlpChatResponse> {
-  const base = (process.env.NLP_SERVICE_URL || 'http://localhost:8000').replace(/\/$/, '');
+}
+
+/** Events of POST /api/chat/stream: meta first, then text deltas, then the full response. */
+export type NlpStreamEvent =
+  | { event: 'meta'; data: Omit<NlpChatResponse, 'answer'> }
+  | { event: 'delta'; data: { text: string } }
+  | { event: 'done'; data: NlpChatResponse };
+
+const nlpBase = () => (process.env.NLP_SERVICE_URL || 'http://localhost:8000').replace(/\/$/, '');
+
+export async function nlpChat(params: NlpChatParams): Promise<NlpChatResponse> {
+  const base = nlpBase();
   const res = await fetch(`${base}/api/chat`, {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
@@ -33,9 +43,34 @@ export async function nlpChat(params: {
   return (await res.json()) as NlpChatResponse;
 }
 
+export async function* nlpChatStream(params: NlpChatParams): AsyncGenerator<NlpStreamEvent> {
+  const res = await fetch(`${nlpBase()}/api/chat/stream`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', Accept: 'text/event-stream' },
+    body: JSON.stringify(params),
+  });
+  if (!res.ok || !res.body) {
+    const text = await res.text().catch(() => '');
+    throw new Error(`NLP error ${res.status}: ${text}`);
+  }
 
-
-
-
-
-
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for await (const chunk of res.body) {
+    buffer += decoder.decode(chunk as Buffer, { stream: true });
+    let sep: number;
+    while ((sep = buffer.indexOf('\n\n')) >= 0) {
+      const raw = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      let event = '';
+      const data: string[] = [];
+      for (const line of raw.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) data.push(line.slice(5).trim());
+      }
+      if (event && data.length) {
+        yield { event, data: JSON.parse(data.join('\n')) } as NlpStreamEvent;
+      }
+    }
+  }
+}
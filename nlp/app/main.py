@@ -1,22 +1,36 @@
 from __future__ import annotations
 
+import json
 import os
-import time
-from typing import List, Literal, Optional
+from contextlib import asynccontextmanager
+from typing import Dict, List, Literal, Optional
 
 from dotenv import load_dotenv
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
+from app.services import metrics
 from app.services.chat_service import ChatService
+from app.services.http_pool import close_async_clients
 
 load_dotenv()
 
-app = FastAPI(title="University Chatbot NLP", version="0.1.0")
-
 chat_service = ChatService()
 
 
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # KB reloads happen on a background thread, never inside a request.
+    chat_service.start_kb_watcher()
+    yield
+    chat_service.stop_kb_watcher()
+    await close_async_clients()
+
+
+app = FastAPI(title="University Chatbot NLP", version="0.1.0", lifespan=lifespan)
+
+
 class ChatRequest(BaseModel):
     message: str = Field(min_length=1)
     conversationId: str = Field(min_length=1)
@@ -34,6 +48,13 @@ class TopMatch(BaseModel):
     similarity: float
 
 
+class GateData(BaseModel):
+    decision: Literal["extractive", "generate"]
+    margin: float
+    overlap: float
+    questionMatch: float
+
+
 class ExplainData(BaseModel):
     detectedLang: Literal["ar", "en"]
     ruleHit: bool
@@ -42,6 +63,10 @@ class ExplainData(BaseModel):
     retrievalMethod: Literal["tfidf", "labse"]  # kept for frontend contract
     topMatches: List[TopMatch]
     decision: Literal["answer", "fallback"]
+    # Extractive fast-path decision (grounded answers only).
+    gate: Optional[GateData] = None
+    # Per-stage milliseconds, only with EXPLAIN_TIMINGS=1.
+    timings: Optional[Dict[str, float]] = None
 
 
 class ChatResponse(BaseModel):
@@ -51,6 +76,30 @@ class ChatResponse(BaseModel):
     explain: ExplainData
 
 
+class SearchBatchRequest(BaseModel):
+    queries: List[str] = Field(min_length=1)
+    language: Literal["ar", "en", "fr"] = "en"
+    topK: Optional[int] = Field(default=None, ge=1)
+
+
+class SearchMatch(BaseModel):
+    id: str
+    title: str
+    url: str
+    type: str
+    text: str
+    similarity: float
+
+
+class SearchBatchResult(BaseModel):
+    query: str
+    matches: List[SearchMatch]
+
+
+class SearchBatchResponse(BaseModel):
+    results: List[SearchBatchResult]
+
+
 @app.get("/api/health")
 def health():
     # Useful debug info (no secrets) to validate env/config at runtime
@@ -59,31 +108,91 @@ def health():
         "kbSize": chat_service.kb_size(),
         "kbFile": chat_service.kb_filename(),
         "dataDir": chat_service.data_dir(),
+        "kbReload": chat_service.kb_reload_status(),
+        "answerCache": chat_service.answer_cache.stats(),
+        "generationCache": chat_service.generation_cache.stats(),
+        "coalescing": chat_service.coalescing_status(),
         "rag": {
             "topK": chat_service.top_k(),
             "minSimilarity": chat_service.min_similarity(),
             "minTokenOverlap": chat_service.min_token_overlap(),
+            "engine": chat_service.retriever_engine(),
+            "questionWeight": chat_service.question_weight(),
         },
         "fallbackLLM": chat_service.fallback_status(),
+        "circuitBreakers": chat_service.circuit_status(),
+        "rateLimits": chat_service.rate_limit_status(),
         "mistral": {"enabled": chat_service.mistral_enabled()},
+        "llmRouter": chat_service.llm_router_status(),
+        "microbatch": chat_service.microbatch_status(),
     }
 
 
-@app.post("/api/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
-    started = time.perf_counter()
-    result = chat_service.answer(
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    # Prometheus text format; per-stage / per-path histograms plus recent p50/p95/p99 summaries.
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/api/chat", response_model=ChatResponse, response_model_exclude_none=True)
+async def chat(req: ChatRequest):
+    # Runs on the event loop: provider calls are awaited, CPU steps go to a worker thread.
+    # Stage timings are recorded by ChatService (/api/metrics, explain.timings with EXPLAIN_TIMINGS=1).
+    return await chat_service.answer_async(
         message=req.message,
         language_hint=req.language,
         conversation_id=req.conversationId,
     )
-    # Frontend expects processing in explain, but its type doesn't include timing here.
-    # Keep pipeline deterministic; timing can be added later without breaking.
-    _ = time.perf_counter() - started
-    return result
-
-
 
 
+@app.post("/api/chat/stream")
+async def chat_stream(req: ChatRequest):
+    """
+    Same answer as /api/chat, streamed as server-sent events:
+    `meta` (lang, sources, explain), then `delta` text chunks, then `done` (full ChatResponse).
+    """
+
+    async def events():
+        async for event, data in chat_service.answer_stream(
+            message=req.message,
+            language_hint=req.language,
+            conversation_id=req.conversationId,
+        ):
+            if event in ("meta", "done"):
+                # Same contract as /api/chat (drops debug-only explain fields).
+                data = ChatResponse.model_validate({"answer": "", **data}).model_dump(exclude_none=True)
+                if event == "meta":
+                    data.pop("answer")
+            yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Disable proxy buffering (nginx) so deltas reach the client as they are produced.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
+@app.post("/api/search/batch", response_model=SearchBatchResponse)
+def search_batch(req: SearchBatchRequest):
+    # Retrieval only (no rules / LLM): used by offline evaluation jobs and bulk prefetching.
+    results = chat_service.search_batch(req.queries, language_hint=req.language, top_k=req.topK)
+    return {
+        "results": [
+            {
+                "query": q,
+                "matches": [
+                    {
+                        "id": r.item.id,
+                        "title": r.item.title,
+                        "url": r.item.url,
+                        "type": r.item.type,
+                        "text": r.item.text,
+                        "similarity": r.similarity,
+                    }
+                    for r in res
+                ],
+            }
+            for q, res in zip(req.queries, results)
+        ]
+    }
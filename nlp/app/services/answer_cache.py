@@ -0,0 +1,340 @@
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.services.retrieval import _tokenize
+
+
+def question_key(message: str) -> str:
+    """Normalized question: the distinct retrieval tokens, sorted (word order / punctuation / case ignored)."""
+    return " ".join(sorted(set(_tokenize(message))))
+
+
+def canonical_question(message: str) -> str:
+    """
+    Looser than question_key: also folds plurals and the Arabic article, so near-duplicate
+    phrasings ("exam date" / "exam dates", "التسجيل" / "تسجيل") share a generation cache entry.
+    """
+    out = set()
+    for t in _tokenize(message):
+        if t.startswith("ال") and len(t) > 4:
+            t = t[2:]
+        elif t.endswith("s") and not t.endswith("ss") and len(t) > 3 and t.isascii():
+            t = t[:-1]
+        out.add(t)
+    return " ".join(sorted(out))
+
+
+class MemoryBackend:
+    """In-process LRU (OrderedDict, most recent last). Entries are (created_at, response)."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        entry = self._data.get(key)
+        if entry is not None:
+            self._data.move_to_end(key)
+        return entry
+
+    def put(self, key: str, created: float, value: Dict[str, Any]) -> int:
+        self._data[key] = (created, value)
+        self._data.move_to_end(key)
+        evicted = 0
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class FileBackend(MemoryBackend):
+    """
+    MemoryBackend persisted to an append-only journal (one JSON record per line: put / del / clear),
+    so cached answers survive a restart. A change appends a line instead of rewriting the file; the
+    journal is compacted (rewritten atomically) once it holds more than twice the live entries.
+    """
+
+    name = "file"
+    # Journals shorter than this are never compacted.
+    _MIN_COMPACT = 256
+
+    def __init__(self, max_entries: int, path: str):
+        super().__init__(max_entries)
+        self.path = path
+        self._records = 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self._replay(line)
+        except OSError:
+            # Missing file: start empty.
+            pass
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+        self._file = None
+
+    def _replay(self, line: str) -> None:
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            # Torn last line after a crash: skip it.
+            return
+        if not isinstance(rec, list) or not rec:
+            # Blank or malformed line: skip it rather than lose the rest of the journal.
+            return
+        self._records += 1
+        op = rec[0]
+        if op == "put" and len(rec) == 4 and isinstance(rec[1], str) and isinstance(rec[2], (int, float)):
+            self._data[rec[1]] = (float(rec[2]), rec[3])
+            self._data.move_to_end(rec[1])
+        elif op == "del" and len(rec) == 2 and isinstance(rec[1], str):
+            self._data.pop(rec[1], None)
+        elif op == "clear":
+            self._data.clear()
+
+    def _append(self, records: List[List[Any]]) -> None:
+        if self._records + len(records) > max(2 * len(self._data), self._MIN_COMPACT):
+            self._compact()
+            return
+        if self._file is None:
+            self._file = self._open_journal()
+        self._file.write("".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in records))
+        self._file.flush()
+        self._records += len(records)
+
+    def _open_journal(self) -> Any:
+        f = open(self.path, "a", encoding="utf-8")
+        if f.tell() > 0:
+            with open(self.path, "rb") as tail:
+                tail.seek(-1, os.SEEK_END)
+                if tail.read(1) != b"\n":
+                    # Torn last record: start a fresh line.
+                    f.write("\n")
+        return f
+
+    def _compact(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for k, (c, v) in self._data.items():
+                f.write(json.dumps(["put", k, c, v], ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+        self._records = len(self._data)
+
+    def put(self, key: str, created: float, value: Dict[str, Any]) -> int:
+        self._data[key] = (created, value)
+        self._data.move_to_end(key)
+        records: List[List[Any]] = [["put", key, created, value]]
+        while len(self._data) > self.max_entries:
+            records.append(["del", self._data.popitem(last=False)[0]])
+        self._append(records)
+        return len(records) - 1
+
+    def delete(self, key: str) -> None:
+        if self._data.pop(key, None) is not None:
+            self._append([["del", key]])
+
+    def clear(self) -> None:
+        super().clear()
+        self._append([["clear"]])
+
+
+class SqliteBackend:
+    """
+    SQLite table (key, created, accessed, value); LRU order is `accessed`. Shareable by several workers.
+    The size bound is enforced every _TRIM_EVERY puts rather than on each one (no COUNT(*) per write),
+    so the table may briefly exceed max_entries by that many rows per worker.
+    """
+
+    name = "sqlite"
+    _TRIM_EVERY = 32
+
+    def __init__(self, max_entries: int, path: str):
+        self.max_entries = max_entries
+        self.path = path
+        self._puts = 0
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers "
+            "(key TEXT PRIMARY KEY, created REAL NOT NULL, accessed REAL NOT NULL, value TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_accessed ON answers (accessed)")
+
+    def get(self, key: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        row = self._conn.execute("SELECT created, value FROM answers WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._conn.execute("UPDATE answers SET accessed = ? WHERE key = ?", (time.time(), key))
+        return float(row[0]), json.loads(row[1])
+
+    def put(self, key: str, created: float, value: Dict[str, Any]) -> int:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO answers (key, created, accessed, value) VALUES (?, ?, ?, ?)",
+            (key, created, time.time(), json.dumps(value, ensure_ascii=False)),
+        )
+        self._puts += 1
+        if self._puts % self._TRIM_EVERY:
+            return 0
+        cur = self._conn.execute(
+            "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        return max(0, cur.rowcount)
+
+    def delete(self, key: str) -> None:
+        self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        self._conn.execute("DELETE FROM answers")
+
+    def __len__(self) -> int:
+        return int(self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0])
+
+
+class AnswerCache:
+    """
+    Final chat responses keyed on (KB version, language, normalized question, pipeline scope).
+    LRU bounded by ANSWER_CACHE_SIZE, entries expire after ANSWER_CACHE_TTL seconds.
+
+    Configure with env:
+      - ANSWER_CACHE: "memory" (default) | "file" | "sqlite" | "off"
+      - ANSWER_CACHE_SIZE: max entries (default 1024)
+      - ANSWER_CACHE_TTL: seconds (default 3600, 0 = no expiry)
+      - ANSWER_CACHE_PATH: file/sqlite location (default DATA_DIR/answer_cache.json|.sqlite)
+    """
+
+    def __init__(self, data_dir: str):
+        self.mode = (os.getenv("ANSWER_CACHE") or "memory").strip().lower()
+        self.max_entries = max(1, int(os.getenv("ANSWER_CACHE_SIZE", "1024")))
+        self.ttl = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+        path = (os.getenv("ANSWER_CACHE_PATH") or "").strip()
+        self.backend: Any = None
+        if self.mode == "memory":
+            self.backend = MemoryBackend(self.max_entries)
+        elif self.mode == "file":
+            self.backend = FileBackend(self.max_entries, path or os.path.join(data_dir, "answer_cache.json"))
+        elif self.mode == "sqlite":
+            self.backend = SqliteBackend(self.max_entries, path or os.path.join(data_dir, "answer_cache.sqlite"))
+
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def key(self, *, kb_version: str, lang: str, message: str, scope: str) -> str:
+        return "\x1f".join((kb_version, lang, scope, question_key(message)))
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.backend is None:
+            return None
+        with self._lock:
+            entry = self.backend.get(key)
+            if entry is not None and self.ttl > 0 and time.time() - entry[0] > self.ttl:
+                self.backend.delete(key)
+                self._stats["expired"] += 1
+                entry = None
+            self._stats["hits" if entry is not None else "misses"] += 1
+            return entry[1] if entry is not None else None
+
+    def put(self, key: str, response: Dict[str, Any]) -> None:
+        if self.backend is None:
+            return
+        with self._lock:
+            self._stats["evictions"] += self.backend.put(key, time.time(), response)
+            self._stats["stores"] += 1
+
+    def clear(self) -> None:
+        """Drop every entry (called when the KB is reloaded)."""
+        if self.backend is None:
+            return
+        with self._lock:
+            self.backend.clear()
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "backend": self.backend.name if self.backend is not None else "off",
+                "size": len(self.backend) if self.backend is not None else 0,
+                "maxEntries": self.max_entries,
+                "ttl": self.ttl,
+                **self._stats,
+                "hitRate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+class GenerationCache:
+    """
+    Grounded LLM answers keyed on (KB version, provider, language, ordered retrieved item ids, canonical
+    question): the RAG prompt is determined by the question and the retrieved blocks, so questions that
+    map to the same evidence reuse one generation. In-process LRU, cleared on KB reload; the KB version
+    keeps a generation still running on the old KB from being served after it.
+
+    Configure with env:
+      - GENERATION_CACHE_SIZE: max entries (default 512, 0 = off)
+    """
+
+    def __init__(self):
+        self.max_entries = int(os.getenv("GENERATION_CACHE_SIZE", "512"))
+        self._lock = threading.Lock()
+        self._data = MemoryBackend(self.max_entries) if self.max_entries > 0 else None
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def enabled(self) -> bool:
+        return self._data is not None
+
+    def key(self, *, kb_version: str, provider: str, lang: str, item_ids: List[str], message: str) -> Optional[str]:
+        if self._data is None:
+            return None
+        return json.dumps([kb_version, provider, lang, item_ids, canonical_question(message)], ensure_ascii=False)
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None or self._data is None:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            self._stats["hits" if entry is not None else "misses"] += 1
+            return entry[1]["answer"] if entry is not None else None
+
+    def put(self, key: Optional[str], answer: str) -> None:
+        if key is None or self._data is None:
+            return
+        with self._lock:
+            self._stats["evictions"] += self._data.put(key, time.time(), {"answer": answer})
+            self._stats["stores"] += 1
+
+    def clear(self) -> None:
+        if self._data is None:
+            return
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._data) if self._data is not None else 0,
+                "maxEntries": self.max_entries,
+                **self._stats,
+            }
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Sequence
+
+from app.services.metrics import GATE_DECISIONS, GATE_SIGNALS, GATE_THRESHOLDS
+from app.services.retrieval import RetrievedChunk, _tokenize
+
+
+def enabled() -> bool:
+    """EXTRACTIVE_FIRST=0 sends every grounded question to the generator (the previous behaviour)."""
+    return (os.getenv("EXTRACTIVE_FIRST") or "1").strip().lower() not in ("0", "false", "no")
+
+
+def thresholds() -> Dict[str, float]:
+    """
+    All three signals must reach their threshold for the extractive fast path:
+      - margin: (top1 - top2) / top1, top2 being the best item with a *different* answer
+      - overlap: share of the question's tokens found in the top item
+      - questionMatch: Dice overlap between the question and the item's "Q:" line
+    """
+    return {
+        "margin": float(os.getenv("EXTRACTIVE_MIN_MARGIN", "0.15")),
+        "overlap": float(os.getenv("EXTRACTIVE_MIN_OVERLAP", "0.8")),
+        "questionMatch": float(os.getenv("EXTRACTIVE_MIN_QUESTION_MATCH", "0.8")),
+    }
+
+
+def settings_key() -> str:
+    # Part of the answer cache scope: changing the gate changes which path answers.
+    t = thresholds()
+    return f"{int(enabled())}:{t['margin']}:{t['overlap']}:{t['questionMatch']}"
+
+
+@dataclass
+class GateResult:
+    passed: bool
+    margin: float
+    overlap: float
+    question_match: float
+
+    def as_explain(self) -> Dict[str, Any]:
+        return {
+            "decision": "extractive" if self.passed else "generate",
+            "margin": round(self.margin, 4),
+            "overlap": round(self.overlap, 4),
+            "questionMatch": round(self.question_match, 4),
+        }
+
+
+def evaluate(question: str, retrieved: Sequence[RetrievedChunk]) -> GateResult:
+    """Is the top match decisive enough to answer with its "A:" part directly (no LLM call)?"""
+    best = retrieved[0]
+    best_answer = best.item.answer
+    # Items repeating the same answer (duplicates) are skipped when a different answer is ranked; without
+    # one the margin is taken against the next hit, and a lone hit has no margin at all.
+    runner_up = next((r.similarity for r in retrieved[1:] if r.item.answer != best_answer), None)
+    if runner_up is None and len(retrieved) > 1:
+        runner_up = retrieved[1].similarity
+    if runner_up is None or best.similarity <= 0:
+        margin = 0.0
+    else:
+        margin = (best.similarity - runner_up) / best.similarity
+
+    query = set(_tokenize(question))
+    item_tokens = set(_tokenize(best.item.text))
+    q_line = set(_tokenize(best.item.question))
+    overlap = len(query & item_tokens) / len(query) if query else 0.0
+    question_match = 2 * len(query & q_line) / (len(query) + len(q_line)) if query and q_line else 0.0
+
+    limits = thresholds()
+    passed = (
+        enabled()
+        and margin >= limits["margin"]
+        and overlap >= limits["overlap"]
+        and question_match >= limits["questionMatch"]
+    )
+    result = GateResult(passed, margin, overlap, question_match)
+    _record(result, limits)
+    return result
+
+
+def _record(result: GateResult, limits: Dict[str, float]) -> None:
+    GATE_DECISIONS.inc(decision="extractive" if result.passed else "generate")
+    for name, value in (("margin", result.margin), ("overlap", result.overlap), ("questionMatch", result.question_match)):
+        GATE_SIGNALS.observe(value, signal=name)
+        GATE_THRESHOLDS.set(limits[name], signal=name)
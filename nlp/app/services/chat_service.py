@@ -1,16 +1,76 @@
 from __future__ import annotations
 
+import asyncio
+import math
 import os
 from pathlib import Path
 import re
-from typing import Any, Dict, List, Literal
-
-from app.services.knowledge_base import KBItem, load_kb, resolve_kb_path
+import threading
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Literal, Sequence, Tuple
+
+from app.services import answer_gate
+from app.services.answer_cache import AnswerCache, GenerationCache
+from app.services.circuit_breaker import breaker_status
+from app.services.knowledge_base import KBItem, kb_changes, kb_version, load_kb, read_kb, resolve_kb_path
 from app.services.language import detect_lang
+from app.services.llm_batch import microbatch_status
+from app.services.llm_router import budget_seconds, hedging_enabled, latency_status, race
 from app.services.fallback_llm import FallbackLLM
+from app.services.metrics import StageTimer, record_context
 from app.services.mistral_client import MistralClient
-from app.services.retrieval import Retriever
+from app.services.prompt_builder import pack_context
+from app.services.rate_limit import rate_limit_status
+from app.services.retrieval import (
+    QuestionFusionRetriever,
+    RetrievedChunk,
+    build_retriever,
+    min_token_overlap,
+    open_index,
+    open_shared_index,
+    question_weight,
+)
 from app.services.rules import apply_rules
+from app.services.single_flight import SingleFlight
+
+
+@dataclass(frozen=True)
+class _KBSnapshot:
+    items: Sequence[KBItem]
+    retriever: Any
+    path: str | None
+    mtime: float | None
+    # Content hash of the KB file (answer cache key).
+    version: str = ""
+    # KB jsonl line -> parsed item (see knowledge_base.read_kb): a reload only parses changed lines.
+    lines: Dict[bytes, KBItem] = field(default_factory=dict)
+
+
+@dataclass
+class _Turn:
+    """State of one chat turn between retrieval and generation."""
+
+    message: str
+    lang: Literal["ar", "en"]
+    # Set when the turn is already answered (rule hit).
+    response: Dict[str, Any] | None = None
+    retrieved: List[RetrievedChunk] = field(default_factory=list)
+    top_matches: List[Dict[str, Any]] = field(default_factory=list)
+    # False when nothing relevant was retrieved (general LLM answer / clarification).
+    grounded: bool = True
+    context: str = ""
+    # Ids of the items that made it into `context` (see prompt_builder.pack_context).
+    context_ids: List[str] = field(default_factory=list)
+    sources: List[Dict[str, Any]] = field(default_factory=list)
+    # Extractive fast-path decision for grounded turns (see answer_gate.py).
+    gate: answer_gate.GateResult | None = None
+    kb: Any = None
+    # Answer cache / single-flight key (None for rule hits) and whether a provider failed on this turn.
+    cache_key: str | None = None
+    degraded: bool = False
+    # Decision path (metrics label) and per-stage timings.
+    path: str = ""
+    timer: StageTimer = field(default_factory=StageTimer)
 
 
 class ChatService:
@@ -27,37 +87,167 @@ class ChatService:
         self._default_data_dir = str(repo_root / "data")
         self._data_dir = os.getenv("DATA_DIR", self._default_data_dir)
 
-        self._kb_path = resolve_kb_path(self._data_dir)
-        self._kb_mtime: float | None = None
-        self.kb_items: List[KBItem] = load_kb(self._data_dir)
-        self.retriever = Retriever(self.kb_items)
-        self._kb_mtime = self._get_kb_mtime()
+        # Current KB + index. Replaced wholesale (single reference swap) on reload, so a
+        # request that grabbed it keeps a consistent view while a new one is published.
+        path, mtime = self._kb_file_state()
+        retriever = self._open_kb_index(path)
+        if retriever is not None:
+            self._kb = _KBSnapshot(
+                items=retriever.items, retriever=retriever, path=path, mtime=mtime, version=kb_version(path)
+            )
+        else:
+            items, lines, version = self._read_kb(path)
+            self._kb = _KBSnapshot(
+                items=items, retriever=build_retriever(items), path=path, mtime=mtime, version=version, lines=lines
+            )
+        self.answer_cache = AnswerCache(self._data_dir)
+        self.generation_cache = GenerationCache()
+        self._flights = SingleFlight()
+        self._kb_reload_stats: Dict[str, int] = {}
+        self._reload_lock = threading.Lock()
+        self._watcher: threading.Thread | None = None
+        self._reloader: threading.Thread | None = None
+        self._watch_stop = threading.Event()
         self.mistral = MistralClient()
         # Note: env vars can change between runs; we'll also refresh per-request before use.
         self.fallback_llm = FallbackLLM()
 
-    def _get_kb_mtime(self) -> float | None:
+    @property
+    def kb_items(self) -> Sequence[KBItem]:
+        return self._kb.items
+
+    @property
+    def retriever(self):
+        return self._kb.retriever
+
+    def _kb_file_state(self) -> Tuple[str | None, float | None]:
         p = resolve_kb_path(self._data_dir)
-        self._kb_path = p
         if not p:
-            return None
+            return None, None
         try:
-            return os.path.getmtime(p)
+            return p, os.path.getmtime(p)
         except Exception:
+            return p, None
+
+    def kb_index_path(self) -> str | None:
+        # Optional on-disk index built with tools/build_index.py (relative paths live in DATA_DIR).
+        name = (os.getenv("KB_INDEX") or "").strip()
+        if not name:
             return None
+        return name if os.path.isabs(name) else os.path.join(self._data_dir, name)
+
+    def kb_shared_index(self) -> bool:
+        return (os.getenv("KB_SHARED_INDEX") or "").strip().lower() in ("1", "true", "yes")
+
+    def _open_kb_index(self, kb_path: str | None):
+        if (os.getenv("RETRIEVER_ENGINE") or "python").strip().lower() != "python":
+            return None
+        if self.kb_index_path():
+            return open_index(self.kb_index_path(), kb_path)
+        if self.kb_shared_index():
+            return open_shared_index(kb_path)
+        return None
+
+    def _read_kb(
+        self, path: str | None, known: Dict[bytes, KBItem] | None = None
+    ) -> Tuple[List[KBItem], Dict[bytes, KBItem], str]:
+        if not path:
+            return load_kb(self._data_dir), {}, kb_version(None)
+        return read_kb(path, known)
+
+    def _kb_changed(self) -> bool:
+        path, new_mtime = self._kb_file_state()
+        if new_mtime is None:
+            return False
+        kb = self._kb
+        return kb.mtime is None or path != kb.path or new_mtime > kb.mtime
 
     def _maybe_reload_kb(self) -> None:
         """
         Auto-reload KB when the jsonl file changes on disk.
         This avoids needing to restart uvicorn after editing data/kb*.jsonl.
+        The new index is built next to the published snapshot, which is never modified.
         """
-        new_mtime = self._get_kb_mtime()
-        if new_mtime is None:
+        if not self._kb_changed():
+            return
+        with self._reload_lock:
+            if not self._kb_changed():
+                return
+            kb = self._kb
+            path, new_mtime = self._kb_file_state()
+            # A prebuilt index matching the new KB file wins over re-indexing.
+            indexed = self._open_kb_index(path)
+            if indexed is not None:
+                self._kb_reload_stats = {"indexed": len(indexed.items)}
+                self._kb = _KBSnapshot(
+                    items=indexed.items, retriever=indexed, path=path, mtime=new_mtime, version=kb_version(path)
+                )
+                self._invalidate_caches()
+                return
+            # Incremental mode only parses changed lines and re-indexes the items they hold
+            # (unchanged lines keep their item objects, which the engines skip by identity).
+            if self.kb_reload_mode() == "incremental" and hasattr(kb.retriever, "updated") and path == kb.path:
+                items, lines, version = self._read_kb(path, kb.lines)
+                changes = kb_changes((kb.items, kb.lines), (items, lines))
+                retriever, stats = kb.retriever.updated(items, changes)
+            else:
+                items, lines, version = self._read_kb(path)
+                retriever, stats = build_retriever(items), {"rebuilt": len(items)}
+            self._kb_reload_stats = stats
+            self._kb = _KBSnapshot(
+                items=items, retriever=retriever, path=path, mtime=new_mtime, version=version, lines=lines
+            )
+            self._invalidate_caches()
+
+    def _invalidate_caches(self) -> None:
+        # Cached answers / generations may cite entries that just changed.
+        self.answer_cache.clear()
+        self.generation_cache.clear()
+
+    # --- background KB watcher ---
+    def kb_watch_interval(self) -> float:
+        return float(os.getenv("KB_WATCH_INTERVAL", "2"))
+
+    def start_kb_watcher(self) -> None:
+        """
+        Poll DATA_DIR from a daemon thread and reload the KB off the request path.
+        With KB_WATCH_INTERVAL<=0 (or before this is called) requests check the file and start the reload.
+        """
+        interval = self.kb_watch_interval()
+        if interval <= 0 or self._watcher is not None:
+            return
+        self._watch_stop.clear()
+        self._watcher = threading.Thread(target=self._watch_kb, args=(interval,), name="kb-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_kb_watcher(self) -> None:
+        if self._watcher is None:
             return
-        if self._kb_mtime is None or new_mtime > self._kb_mtime:
-            self.kb_items = load_kb(self._data_dir)
-            self.retriever = Retriever(self.kb_items)
-            self._kb_mtime = new_mtime
+        self._watch_stop.set()
+        self._watcher.join(timeout=5)
+        self._watcher = None
+
+    def _watch_kb(self, interval: float) -> None:
+        while not self._watch_stop.wait(interval):
+            self._reload_kb_quietly()
+
+    def _reload_kb_quietly(self) -> None:
+        try:
+            self._maybe_reload_kb()
+        except Exception:
+            # e.g. a half-written jsonl: keep serving the current snapshot and retry later.
+            pass
+
+    def _request_kb(self) -> _KBSnapshot:
+        # Without the watcher, a request that notices a change starts a one-off reload thread;
+        # it (and the requests after it) keep answering from the current snapshot meanwhile.
+        if self._watcher is None and self._kb_changed():
+            reloader = self._reloader
+            if reloader is None or not reloader.is_alive():
+                reloader = threading.Thread(target=self._reload_kb_quietly, name="kb-reload", daemon=True)
+                self._reloader = reloader
+                reloader.start()
+        return self._kb
 
     # --- debug helpers (no secrets) ---
     def kb_size(self) -> int:
@@ -73,7 +263,28 @@ class ChatService:
         return float(os.getenv("MIN_SIMILARITY", "0.25"))
 
     def min_token_overlap(self) -> int:
-        return int(os.getenv("MIN_TOKEN_OVERLAP", "2"))
+        return min_token_overlap()
+
+    def retriever_engine(self) -> str:
+        return self.retriever.engine
+
+    def question_weight(self) -> float:
+        # 0 when the active index has no question part (disabled, no "Q:" entries, prebuilt index).
+        return question_weight() if isinstance(self.retriever, QuestionFusionRetriever) else 0.0
+
+    def kb_reload_mode(self) -> str:
+        return (os.getenv("KB_RELOAD") or "incremental").strip().lower()
+
+    def kb_reload_status(self) -> Dict[str, Any]:
+        return {
+            "mode": self.kb_reload_mode(),
+            "watcher": self._watcher is not None,
+            "watchInterval": self.kb_watch_interval(),
+            "indexFile": self.kb_index_path(),
+            "sharedIndex": self.kb_shared_index(),
+            "indexLoaded": bool(getattr(self._kb.retriever, "from_index", False)),
+            "last": self._kb_reload_stats,
+        }
 
     def mistral_enabled(self) -> bool:
         return self.mistral.available()
@@ -86,29 +297,33 @@ class ChatService:
             "hasGeminiKey": bool(os.getenv("GEMINI_API_KEY")),
             "geminiModel": (os.getenv("GEMINI_MODEL") or "").strip() or None,
             "geminiApiVersion": (os.getenv("GEMINI_API_VERSION") or "").strip() or None,
+            "geminiResolved": "/".join(llm.gemini_resolved() or ()) or None,
             "hasOpenAIKey": bool(os.getenv("OPENAI_API_KEY")),
             "openaiModel": (os.getenv("OPENAI_MODEL") or "").strip() or None,
             "llmMode": (os.getenv("LLM_MODE") or "auto").strip().lower(),
         }
 
+    def llm_router_status(self) -> Dict[str, Any]:
+        return {"budgetSeconds": budget_seconds(), "hedge": hedging_enabled(), "providers": latency_status()}
+
+    def microbatch_status(self) -> Dict[str, Any]:
+        return microbatch_status()
+
+    def rate_limit_status(self) -> Dict[str, Any]:
+        return rate_limit_status()
+
+    def circuit_status(self) -> Dict[str, Dict[str, Any]]:
+        return breaker_status()
+
+    def coalescing_status(self) -> Dict[str, int]:
+        return self._flights.stats()
+
     def kb_filename(self) -> str:
-        p = resolve_kb_path(self._data_dir)
+        p = self._kb.path
         if not p:
             return "default_seed"
         return Path(p).name
 
-    def _extract_answer(self, text: str) -> str:
-        """
-        Our KB entries often look like:
-          Q: ...
-          A: ...
-        For UI quality, return only the A part when present.
-        """
-        m = re.search(r"(?mi)^\s*A:\s*(.+)$", text or "")
-        if m:
-            return m.group(1).strip()
-        return (text or "").strip()
-
     def _already_has_citation(self, text: str) -> bool:
         return bool(re.search(r"\[\d+\]", text or ""))
 
@@ -135,19 +350,41 @@ class ChatService:
             head = s[:max_chars].strip()
         return head[:max_chars].strip()
 
-    def answer(
-        self,
-        message: str,
-        language_hint: str,
-        conversation_id: str,
-    ) -> Dict[str, Any]:
-        lang: Literal["ar", "en"] = detect_lang(message, language_hint)
-        self._maybe_reload_kb()
+    def search_batch(self, queries: List[str], language_hint: str, top_k: int | None = None) -> List[List[RetrievedChunk]]:
+        """
+        Retrieval only, for many questions at once (offline evaluation / prefetch).
+        Queries are grouped by detected language so each gets the same filter as /api/chat.
+        """
+        kb = self._request_kb()
+        k = top_k if top_k is not None else self.top_k()
+        groups: Dict[str, List[int]] = {}
+        for i, q in enumerate(queries):
+            groups.setdefault(detect_lang(q, language_hint), []).append(i)
+        out: List[List[RetrievedChunk]] = [[] for _ in queries]
+        for lang, idxs in groups.items():
+            results = kb.retriever.search_batch([queries[i] for i in idxs], top_k=k, lang=lang)
+            for i, res in zip(idxs, results):
+                out[i] = res
+        return out
+
+    # --- answer pipeline ---
+    # `answer` and `answer_async` share every step except the provider calls:
+    # _prepare (language, rules, answer cache) -> _retrieve (retrieval, context) -> LLM call(s)
+    # -> response builders.
+    def _prepare(self, message: str, language_hint: str) -> _Turn:
+        timer = StageTimer()
+        with timer.stage("lang_detect"):
+            lang: Literal["ar", "en"] = detect_lang(message, language_hint)
+        with timer.stage("kb_reload_check"):
+            kb = self._request_kb()
+        turn = _Turn(message=message, lang=lang, timer=timer)
 
         # 1) Rule-based router (quick clarification prompts)
-        rule = apply_rules(message, lang)
+        with timer.stage("rules"):
+            rule = apply_rules(message, lang)
         if rule:
-            return {
+            turn.path = "rule"
+            turn.response = {
                 "answer": rule.answer,
                 "lang": lang,
                 "sources": [],
@@ -161,99 +398,50 @@ class ChatService:
                     "decision": "answer",
                 },
             }
+            return turn
+
+        # 2) Answer cache: same normalized question, language and KB version -> same answer.
+        # The key also identifies identical questions in flight (single-flight coalescing).
+        turn.kb = kb
+        with timer.stage("answer_cache"):
+            turn.cache_key = self.answer_cache.key(
+                kb_version=kb.version, lang=lang, message=message, scope=self._answer_cache_scope()
+            )
+            cached = self.answer_cache.get(turn.cache_key)
+        if cached is not None:
+            turn.path = "answer_cache"
+            turn.response = cached
+        return turn
 
-        # 2) Retrieval
-        retrieved = self.retriever.search(message, top_k=int(os.getenv("TOP_K", "4")), lang=lang)
+    def _retrieve(self, turn: _Turn) -> _Turn:
+        kb, message, lang = turn.kb, turn.message, turn.lang
 
-        top_matches = [{"text": r.item.text[:240], "similarity": r.similarity} for r in retrieved]
+        # 3) Retrieval
+        with turn.timer.stage("retrieval"):
+            retrieved = kb.retriever.search(message, top_k=int(os.getenv("TOP_K", "4")), lang=lang)
+        turn.retrieved = retrieved
+        turn.top_matches = [{"text": r.item.text[:240], "similarity": r.similarity} for r in retrieved]
 
         # If nothing relevant, Gemini/OpenAI generates a general answer.
         # Score scale differs from embeddings; keep a small threshold.
         min_sim = float(os.getenv("MIN_SIMILARITY", "0.25"))
         if not retrieved or retrieved[0].similarity < min_sim:
-            # Optional fallback to external LLM (Gemini/OpenAI) when KB doesn't contain the answer.
-            # Refresh env-based config (important on Windows where users often restart shells).
-            self.fallback_llm = FallbackLLM()
-            if self.fallback_llm.available():
-                try:
-                    disclaimer = (
-                        "تنبيه: هذه الإجابة عامة وليست مبنية على وثائق الجامعة الداخلية.\n\n"
-                        if lang == "ar"
-                        else "Note: This is a general answer and is NOT based on the university's internal documents.\n\n"
-                    )
-                    llm_answer = self.fallback_llm.complete(lang=lang, user_message=message).strip()
-                    llm_answer = self._shorten_general_llm_answer(lang, llm_answer)
-                    return {
-                        "answer": disclaimer + llm_answer,
-                        "lang": lang,
-                        "sources": [],
-                        "explain": {
-                            "detectedLang": lang,
-                            "ruleHit": False,
-                            "intent": "fallback_llm",
-                            "intentConfidence": 0.2,
-                            "retrievalMethod": "tfidf",
-                            "topMatches": top_matches,
-                            "decision": "answer",
-                        },
-                    }
-                except Exception as e:
-                    # If the external LLM fails, return a clearer fallback so debugging is easy.
-                    debug_line = f"{type(e).__name__}: {e}"
-                    prefix = (
-                        "تعذر الاتصال بخدمة Gemini/OpenAI. تحقق من المفتاح (API key) والصلاحيات/الحصة (quota) واسم النموذج.\n"
-                        if lang == "ar"
-                        else "Could not reach Gemini/OpenAI. Check API key, permissions/quota, and model name.\n"
-                    )
-                    fallback = (
-                        "عذراً، لم أجد هذه المعلومة في الوثائق المتاحة. هل يمكنك توضيح سؤالك أو ذكر الشعبة/المستوى؟"
-                        if lang == "ar"
-                        else "Sorry — I couldn't find this in the available documents. Can you clarify your question or share your program/level?"
-                    )
-                    return {
-                        "answer": f"{prefix}{fallback}\n\n(Details: {debug_line})",
-                        "lang": lang,
-                        "sources": [],
-                        "explain": {
-                            "detectedLang": lang,
-                            "ruleHit": False,
-                            "intent": "fallback_llm_error",
-                            "intentConfidence": 0.0,
-                            "retrievalMethod": "tfidf",
-                            "topMatches": top_matches,
-                            "decision": "fallback",
-                        },
-                    }
-
-            # If we reach here, external LLM is NOT enabled (or no key/provider).
-            fallback = (
-                "عذراً، لم أجد هذه المعلومة في الوثائق المتاحة. هل يمكنك توضيح سؤالك أو ذكر الشعبة/المستوى؟"
-                if lang == "ar"
-                else "Sorry — I couldn't find this in the available documents. Can you clarify your question or share your program/level?"
-            )
-            return {
-                "answer": fallback,
-                "lang": lang,
-                "sources": [],
-                "explain": {
-                    "detectedLang": lang,
-                    "ruleHit": False,
-                    "intent": "unknown",
-                    "intentConfidence": 0.0,
-                    "retrievalMethod": "tfidf",
-                    "topMatches": top_matches,
-                    "decision": "fallback",
-                    "fallbackLLM": self.fallback_status(),
-                },
-            }
-
-        # 3) Build context for RAG (then ALWAYS ask Gemini/OpenAI to reformulate short/pro)
-        context_blocks: List[str] = []
-        for i, r in enumerate(retrieved, start=1):
-            context_blocks.append(f"[{i}] {r.item.title}\nURL: {r.item.url}\n{r.item.text}")
-        context = "\n\n".join(context_blocks)
-
-        sources = [
+            turn.grounded = False
+            return turn
+
+        # 4) Extractive-first: a decisive Q/A match is answered with its "A:" part, no LLM call.
+        with turn.timer.stage("gate"):
+            turn.gate = answer_gate.evaluate(message, retrieved)
+
+        # 5) Otherwise build context for RAG (then ask Gemini/OpenAI to reformulate short/pro)
+        if not turn.gate.passed:
+            with turn.timer.stage("prompt_build"):
+                packed = pack_context(message, retrieved)
+                turn.context = packed.text
+                turn.context_ids = [retrieved[n - 1].item.id for n in packed.numbers]
+                record_context(packed)
+
+        turn.sources = [
             {
                 "title": r.item.title,
                 "url": r.item.url,
@@ -261,70 +449,503 @@ class ChatService:
             }
             for r in retrieved
         ]
+        return turn
 
-        # Preferred path: grounded generation with Gemini/OpenAI
-        self.fallback_llm = FallbackLLM()
-        if self.fallback_llm.available():
-            try:
-                answer_text = self.fallback_llm.answer_with_sources(
-                    lang=lang, question=message, sources_text=context
-                ).strip()
-                return {
-                    "answer": answer_text,
-                    "lang": lang,
-                    "sources": sources,
-                    "explain": {
-                        "detectedLang": lang,
-                        "ruleHit": False,
-                        "intent": "rag_llm_rewrite",
-                        "intentConfidence": 0.75,
-                        "retrievalMethod": "tfidf",
-                        "topMatches": top_matches,
-                        "decision": "answer",
-                    },
-                }
-            except Exception:
-                # If Gemini/OpenAI fails, fall back to extractive.
-                pass
+    def _answer_cache_scope(self) -> str:
+        # Settings that change which answer path runs; answers cached under other settings don't apply.
+        llm = FallbackLLM()
+        return "|".join(
+            (
+                llm.provider if llm.available() else "",
+                "mistral" if self.mistral.available() else "",
+                str(self.top_k()),
+                str(self.min_similarity()),
+                answer_gate.settings_key(),
+            )
+        )
 
+    def _generation_key(self, turn: _Turn, provider: str) -> str | None:
+        return self.generation_cache.key(
+            kb_version=turn.kb.version, provider=provider, lang=turn.lang, item_ids=turn.context_ids, message=turn.message
+        )
+
+    def explain_timings(self) -> bool:
+        return (os.getenv("EXPLAIN_TIMINGS") or "").strip().lower() in ("1", "true", "yes")
+
+    def _finish(self, turn: _Turn, response: Dict[str, Any]) -> Dict[str, Any]:
+        # Coalesced followers never ran a stage themselves: they are their own decision path.
+        turn.timer.finish(turn.path or "coalesced")
+        if not self.explain_timings():
+            return response
+        # Cached / coalesced responses are shared objects: copy before adding per-request data.
+        return {**response, "explain": {**response["explain"], "timings": turn.timer.as_ms()}}
+
+    def _remember(self, turn: _Turn, response: Dict[str, Any]) -> Dict[str, Any]:
+        # Answers produced after a provider failure (error text / extractive fallback) aren't cached.
+        if turn.cache_key is not None and not turn.degraded:
+            self.answer_cache.put(turn.cache_key, response)
+        return response
+
+    async def _remember_async(self, turn: _Turn, response: Dict[str, Any]) -> Dict[str, Any]:
+        # file / sqlite backends write to disk: keep that off the event loop.
+        if turn.cache_key is not None and not turn.degraded and self.answer_cache.mode != "memory":
+            return await asyncio.to_thread(self._remember, turn, response)
+        return self._remember(turn, response)
+
+    def _general_disclaimer(self, lang: Literal["ar", "en"]) -> str:
+        return (
+            "تنبيه: هذه الإجابة عامة وليست مبنية على وثائق الجامعة الداخلية.\n\n"
+            if lang == "ar"
+            else "Note: This is a general answer and is NOT based on the university's internal documents.\n\n"
+        )
+
+    def _not_found_text(self, lang: Literal["ar", "en"]) -> str:
+        return (
+            "عذراً، لم أجد هذه المعلومة في الوثائق المتاحة. هل يمكنك توضيح سؤالك أو ذكر الشعبة/المستوى؟"
+            if lang == "ar"
+            else "Sorry — I couldn't find this in the available documents. Can you clarify your question or share your program/level?"
+        )
+
+    def _general_llm_response(self, turn: _Turn, llm_answer: str) -> Dict[str, Any]:
+        turn.path = "general_llm"
+        llm_answer = self._shorten_general_llm_answer(turn.lang, llm_answer.strip())
+        return {
+            "answer": self._general_disclaimer(turn.lang) + llm_answer,
+            "lang": turn.lang,
+            "sources": [],
+            "explain": {
+                "detectedLang": turn.lang,
+                "ruleHit": False,
+                "intent": "fallback_llm",
+                "intentConfidence": 0.2,
+                "retrievalMethod": "tfidf",
+                "topMatches": turn.top_matches,
+                "decision": "answer",
+            },
+        }
+
+    def _general_llm_error_response(self, turn: _Turn, e: Exception) -> Dict[str, Any]:
+        # If the external LLM fails, return a clearer fallback so debugging is easy.
+        turn.path = "general_llm_error"
+        debug_line = f"{type(e).__name__}: {e}"
+        prefix = (
+            "تعذر الاتصال بخدمة Gemini/OpenAI. تحقق من المفتاح (API key) والصلاحيات/الحصة (quota) واسم النموذج.\n"
+            if turn.lang == "ar"
+            else "Could not reach Gemini/OpenAI. Check API key, permissions/quota, and model name.\n"
+        )
+        return {
+            "answer": f"{prefix}{self._not_found_text(turn.lang)}\n\n(Details: {debug_line})",
+            "lang": turn.lang,
+            "sources": [],
+            "explain": {
+                "detectedLang": turn.lang,
+                "ruleHit": False,
+                "intent": "fallback_llm_error",
+                "intentConfidence": 0.0,
+                "retrievalMethod": "tfidf",
+                "topMatches": turn.top_matches,
+                "decision": "fallback",
+            },
+        }
+
+    def _unknown_response(self, turn: _Turn) -> Dict[str, Any]:
+        # External LLM is NOT enabled (or no key/provider).
+        turn.path = "unknown"
+        return {
+            "answer": self._not_found_text(turn.lang),
+            "lang": turn.lang,
+            "sources": [],
+            "explain": {
+                "detectedLang": turn.lang,
+                "ruleHit": False,
+                "intent": "unknown",
+                "intentConfidence": 0.0,
+                "retrievalMethod": "tfidf",
+                "topMatches": turn.top_matches,
+                "decision": "fallback",
+                "fallbackLLM": self.fallback_status(),
+            },
+        }
+
+    def _rag_llm_response(self, turn: _Turn, answer_text: str) -> Dict[str, Any]:
+        turn.path = "rag_llm"
+        return {
+            "answer": answer_text.strip(),
+            "lang": turn.lang,
+            "sources": turn.sources,
+            "explain": {
+                "detectedLang": turn.lang,
+                "ruleHit": False,
+                "intent": "rag_llm_rewrite",
+                "intentConfidence": 0.75,
+                "retrievalMethod": "tfidf",
+                "topMatches": turn.top_matches,
+                "decision": "answer",
+                "gate": turn.gate.as_explain() if turn.gate is not None else None,
+            },
+        }
+
+    def _rag_prompt(self, turn: _Turn) -> Tuple[str, str]:
         system = (
             "You are a university student-services assistant. "
             "Answer ONLY using the provided sources. If the sources do not contain the answer, say you don't know and ask a clarifying question. "
             "Always answer in the user's language (Arabic if Arabic, otherwise English)."
         )
         user = (
-            f"User question:\n{message}\n\nSources:\n{context}\n\n"
+            f"User question:\n{turn.message}\n\nSources:\n{turn.context}\n\n"
             "Return a helpful answer and cite sources by numbers like [1], [2] when relevant."
         )
+        return system, user
 
-        # 4) Generation (Mistral) with safe fallback (extractive)
-        try:
-            if self.mistral.available():
-                answer_text = self.mistral.chat(system=system, user=user).strip()
-            else:
-                # No generator model: return a clean extractive answer (prefer the best match only).
-                best = retrieved[0]
-                ans = self._extract_answer(best.item.text)
-                cite = "[1]"
-                answer_text = ans if self._already_has_citation(ans) else f"{ans} {cite}".strip()
-        except Exception:
-            best = retrieved[0]
-            ans = self._extract_answer(best.item.text)
-            answer_text = ans if self._already_has_citation(ans) else f"{ans} [1]".strip()
+    def _extractive_answer(self, turn: _Turn) -> str:
+        # No generator model: return a clean extractive answer (prefer the best match only).
+        best = turn.retrieved[0]
+        ans = best.item.answer
+        return ans if self._already_has_citation(ans) else f"{ans} [1]".strip()
+
+    def _fast_path_response(self, turn: _Turn) -> Dict[str, Any]:
+        with turn.timer.stage("extractive"):
+            return self._rag_response(turn, self._extractive_answer(turn), "rag_fast_path")
 
+    def _rag_response(self, turn: _Turn, answer_text: str, path: str) -> Dict[str, Any]:
+        turn.path = path
         return {
             "answer": answer_text,
-            "lang": lang,
-            "sources": sources,
+            "lang": turn.lang,
+            "sources": turn.sources,
             "explain": {
-                "detectedLang": lang,
+                "detectedLang": turn.lang,
                 "ruleHit": False,
                 "intent": "rag_answer",
                 "intentConfidence": 0.6,
                 "retrievalMethod": "tfidf",
-                "topMatches": top_matches,
+                "topMatches": turn.top_matches,
                 "decision": "answer",
+                "gate": turn.gate.as_explain() if turn.gate is not None else None,
             },
         }
 
+    def answer(
+        self,
+        message: str,
+        language_hint: str,
+        conversation_id: str,
+    ) -> Dict[str, Any]:
+        turn = self._prepare(message, language_hint)
+        if turn.response is not None:
+            return self._finish(turn, turn.response)
+        # Identical questions arriving together share one retrieval + generation.
+        return self._finish(turn, self._flights.do(turn.cache_key, lambda: self._answer_turn(turn)))
+
+    def _answer_turn(self, turn: _Turn) -> Dict[str, Any]:
+        self._retrieve(turn)
+        return self._remember(turn, self._generate(turn))
+
+    def _generate(self, turn: _Turn) -> Dict[str, Any]:
+        message = turn.message
+        timer = turn.timer
+        # Refresh env-based config (important on Windows where users often restart shells).
+        self.fallback_llm = FallbackLLM()
+        provider = self.fallback_llm.provider
+        if not turn.grounded:
+            # Optional fallback to external LLM (Gemini/OpenAI) when KB doesn't contain the answer.
+            if not self.fallback_llm.available():
+                return self._unknown_response(turn)
+            try:
+                with timer.llm(provider):
+                    llm_answer = self.fallback_llm.complete(lang=turn.lang, user_message=message)
+                return self._general_llm_response(turn, llm_answer)
+            except Exception as e:
+                turn.degraded = True
+                return self._general_llm_error_response(turn, e)
+        if turn.gate.passed:
+            return self._fast_path_response(turn)
+
+        # Preferred path: grounded generation with Gemini/OpenAI
+        if self.fallback_llm.available():
+            # Same evidence + same canonical question -> reuse the grounded answer.
+            gen_key = self._generation_key(turn, provider)
+            cached = self.generation_cache.get(gen_key)
+            if cached is not None:
+                response = self._rag_llm_response(turn, cached)
+                turn.path = "generation_cache"
+                return response
+            try:
+                with timer.llm(provider):
+                    llm_answer = self.fallback_llm.answer_with_sources(
+                        lang=turn.lang, question=message, sources_text=turn.context
+                    )
+                self.generation_cache.put(gen_key, llm_answer)
+                return self._rag_llm_response(turn, llm_answer)
+            except Exception:
+                # If Gemini/OpenAI fails, fall back to extractive.
+                turn.degraded = True
+
+        # 5) Generation (Mistral) with safe fallback (extractive)
+        try:
+            if self.mistral.available():
+                gen_key = self._generation_key(turn, "mistral")
+                answer_text = self.generation_cache.get(gen_key)
+                path = "rag_mistral" if answer_text is None else "generation_cache"
+                if answer_text is None:
+                    with timer.llm("mistral"):
+                        answer_text = self.mistral.chat(*self._rag_prompt(turn)).strip()
+                    self.generation_cache.put(gen_key, answer_text)
+            else:
+                with timer.stage("extractive"):
+                    answer_text = self._extractive_answer(turn)
+                path = "rag_extractive"
+        except Exception:
+            turn.degraded = True
+            with timer.stage("extractive"):
+                answer_text = self._extractive_answer(turn)
+            path = "rag_extractive"
+        return self._rag_response(turn, answer_text, path)
+
+    async def answer_async(
+        self,
+        message: str,
+        language_hint: str,
+        conversation_id: str,
+    ) -> Dict[str, Any]:
+        """
+        Same pipeline as `answer`, but provider calls go through async HTTP clients so an
+        event loop can hold many in-flight LLM calls. Retrieval (CPU-bound) runs in a thread.
+        """
+        turn = await asyncio.to_thread(self._prepare, message, language_hint)
+        if turn.response is not None:
+            return self._finish(turn, turn.response)
+        response = await self._flights.do_async(turn.cache_key, lambda: self._answer_turn_async(turn))
+        return self._finish(turn, response)
+
+    async def _answer_turn_async(self, turn: _Turn) -> Dict[str, Any]:
+        await asyncio.to_thread(self._retrieve, turn)
+        return await self._remember_async(turn, await self._generate_async(turn))
+
+    async def _generate_async(self, turn: _Turn) -> Dict[str, Any]:
+        message = turn.message
+        timer = turn.timer
+        self.fallback_llm = FallbackLLM()
+        provider = self.fallback_llm.provider
+        if not turn.grounded:
+            if not self.fallback_llm.available():
+                return self._unknown_response(turn)
+            try:
+                with timer.llm(provider):
+                    llm_answer = await asyncio.wait_for(
+                        self.fallback_llm.complete_async(lang=turn.lang, user_message=message),
+                        timeout=budget_seconds() or None,
+                    )
+                return self._general_llm_response(turn, llm_answer)
+            except Exception as e:
+                turn.degraded = True
+                return self._general_llm_error_response(turn, e)
+        if turn.gate.passed:
+            return self._fast_path_response(turn)
+
+        # Grounded generation: race the configured providers within the latency budget
+        # (hedging to the next one when the first is slow), extractive answer as the floor.
+        names: List[str] = []
+        calls: Dict[str, Callable[[], Awaitable[str]]] = {}
+        if self.fallback_llm.available():
+            names.append(provider)
+            calls[provider] = lambda: self.fallback_llm.answer_with_sources_async(
+                lang=turn.lang, question=message, sources_text=turn.context
+            )
+        if self.mistral.available():
+            names.append("mistral")
+            calls["mistral"] = lambda: self.mistral.chat_async(*self._rag_prompt(turn))
+        for name in names:
+            # Same evidence + same canonical question -> reuse the grounded answer.
+            cached = self.generation_cache.get(self._generation_key(turn, name))
+            if cached is not None:
+                response = self._grounded_response(turn, name, cached)
+                turn.path = "generation_cache"
+                return response
+
+        won = await race([(name, self._timed_llm(turn, name, calls[name])) for name in names], budget_seconds())
+        if won is not None:
+            name, llm_answer = won
+            if name == "mistral":
+                llm_answer = llm_answer.strip()
+            self.generation_cache.put(self._generation_key(turn, name), llm_answer)
+            return self._grounded_response(turn, name, llm_answer)
+
+        # Every provider failed or the budget ran out.
+        turn.degraded = bool(names)
+        with timer.stage("extractive"):
+            answer_text = self._extractive_answer(turn)
+        return self._rag_response(turn, answer_text, "rag_extractive")
+
+    def _timed_llm(
+        self, turn: _Turn, provider: str, call: Callable[[], Awaitable[str]]
+    ) -> Callable[[], Awaitable[str]]:
+        async def timed() -> str:
+            with turn.timer.llm(provider):
+                return await call()
+
+        return timed
+
+    def _grounded_response(self, turn: _Turn, provider: str, answer_text: str) -> Dict[str, Any]:
+        # FallbackLLM rewrites are "rag_llm_rewrite"; Mistral keeps the historical "rag_answer" intent.
+        if provider == "mistral":
+            return self._rag_response(turn, answer_text, "rag_mistral")
+        return self._rag_llm_response(turn, answer_text)
+
+    async def answer_stream(
+        self,
+        message: str,
+        language_hint: str,
+        conversation_id: str,
+    ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Streaming variant of `answer_async`, as (event, data) pairs:
+          - "meta": lang / sources / explain, sent with the first token,
+          - "delta": {"text": ...} chunks as the provider produces them,
+          - "done": the full response; its answer is authoritative (post-processing, or the
+            fallback text when a provider fails after it started streaming).
+        Providers are tried in order, but only until LLM_BUDGET_SECONDS after retrieval for the
+        first token; past that the extractive answer is sent instead.
+        """
+        turn = await asyncio.to_thread(self._prepare, message, language_hint)
+        if turn.response is not None:
+            for ev in _whole_response_events(self._finish(turn, turn.response)):
+                yield ev
+            return
+        await asyncio.to_thread(self._retrieve, turn)
 
+        timer = turn.timer
+        self.fallback_llm = FallbackLLM()
+        provider = self.fallback_llm.provider
+        budget = budget_seconds()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + budget if budget > 0 else math.inf
+        parts: List[str] = []
+        response: Dict[str, Any] | None = None
+        if not turn.grounded:
+            if not self.fallback_llm.available():
+                response = self._unknown_response(turn)
+            else:
+                try:
+                    with timer.llm(provider):
+                        async for ev in _relay(
+                            self.fallback_llm.complete_stream(lang=turn.lang, user_message=message),
+                            self._general_llm_response(turn, ""),
+                            parts,
+                            prefix=self._general_disclaimer(turn.lang),
+                            deadline=deadline,
+                        ):
+                            yield ev
+                    response = self._general_llm_response(turn, "".join(parts))
+                except Exception as e:
+                    turn.degraded = True
+                    response = self._general_llm_error_response(turn, e)
+        elif turn.gate.passed:
+            response = self._fast_path_response(turn)
+
+        if response is None and self.fallback_llm.available():
+            gen_key = self._generation_key(turn, provider)
+            cached = self.generation_cache.get(gen_key)
+            if cached is not None:
+                response = self._rag_llm_response(turn, cached)
+                turn.path = "generation_cache"
+            else:
+                try:
+                    with timer.llm(provider):
+                        async for ev in _relay(
+                            self.fallback_llm.answer_with_sources_stream(
+                                lang=turn.lang, question=message, sources_text=turn.context
+                            ),
+                            self._rag_llm_response(turn, ""),
+                            parts,
+                            deadline=deadline,
+                        ):
+                            yield ev
+                    self.generation_cache.put(gen_key, "".join(parts))
+                    response = self._rag_llm_response(turn, "".join(parts))
+                except Exception:
+                    turn.degraded = True
+
+        # Only start another provider if nothing was streamed yet and the budget isn't spent;
+        # otherwise settle on extractive.
+        if response is None and not parts and loop.time() < deadline and self.mistral.available():
+            gen_key = self._generation_key(turn, "mistral")
+            cached = self.generation_cache.get(gen_key)
+            if cached is not None:
+                response = self._rag_response(turn, cached, "generation_cache")
+            else:
+                try:
+                    with timer.llm("mistral"):
+                        async for ev in _relay(
+                            self.mistral.chat_stream(*self._rag_prompt(turn)),
+                            self._rag_response(turn, "", "rag_mistral"),
+                            parts,
+                            deadline=deadline,
+                        ):
+                            yield ev
+                    self.generation_cache.put(gen_key, "".join(parts).strip())
+                    response = self._rag_response(turn, "".join(parts).strip(), "rag_mistral")
+                except Exception:
+                    turn.degraded = True
+
+        if response is None:
+            with timer.stage("extractive"):
+                response = self._rag_response(turn, self._extractive_answer(turn), "rag_extractive")
+        response = self._finish(turn, await self._remember_async(turn, response))
+        if not parts:
+            for ev in _whole_response_events(response):
+                yield ev
+            return
+        yield "done", response
+
+
+def _response_meta(response: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in response.items() if k != "answer"}
+
+
+def _whole_response_events(response: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    # Non-streamed answers (rules, extractive, errors) go out as a single delta.
+    return [
+        ("meta", _response_meta(response)),
+        ("delta", {"text": response["answer"]}),
+        ("done", response),
+    ]
+
+
+async def _relay(
+    deltas: AsyncIterator[str],
+    response: Dict[str, Any],
+    parts: List[str],
+    prefix: str = "",
+    deadline: float = math.inf,
+) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Forward provider deltas as events, collecting them into `parts`. "meta" is held back until
+    the first chunk so a provider failing up front can still fall back without a stray event.
+    Raises TimeoutError when the first chunk hasn't arrived by `deadline` (event loop time).
+    """
+    loop = asyncio.get_running_loop()
+    it = deltas.__aiter__()
+    try:
+        while True:
+            try:
+                if parts or math.isinf(deadline):
+                    text = await it.__anext__()
+                else:
+                    text = await asyncio.wait_for(it.__anext__(), timeout=max(deadline - loop.time(), 0.0))
+            except StopAsyncIteration:
+                break
+            if not text:
+                continue
+            if not parts:
+                yield "meta", _response_meta(response)
+                if prefix:
+                    yield "delta", {"text": prefix}
+            parts.append(text)
+            yield "delta", {"text": text}
+    finally:
+        aclose = getattr(it, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    if not parts:
+        raise RuntimeError("Provider returned an empty stream")
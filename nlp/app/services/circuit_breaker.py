@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+
+class CircuitOpen(RuntimeError):
+    """Raised instead of calling a provider whose breaker is open (callers fall through to the next one)."""
+
+
+def _http_error(exc: Optional[BaseException]) -> Tuple[Optional[int], Any]:
+    # requests.HTTPError / httpx.HTTPStatusError carry .response; wrappers chain them as __cause__.
+    while exc is not None:
+        resp = getattr(exc, "response", None)
+        status = getattr(resp, "status_code", None)
+        if status is not None:
+            return int(status), resp
+        exc = exc.__cause__
+    return None, None
+
+
+def _retry_after(resp: Any) -> float:
+    try:
+        return max(0.0, float(resp.headers.get("Retry-After") or 0))
+    except Exception:
+        # HTTP-date form (or no headers): ignore, the cooldown applies.
+        return 0.0
+
+
+class CircuitBreaker:
+    """
+    Per-provider breaker: closed -> open after LLM_BREAKER_FAILURES consecutive errors (or at once on
+    a 429), half-open after the cooldown (one probe call at a time), closed again on success.
+    A failed probe doubles the cooldown up to LLM_BREAKER_MAX_COOLDOWN; Retry-After is honoured.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.cooldown = 0.0
+        self.trips = 0
+        self.last_error = ""
+        self._probing = False
+
+    def _threshold(self) -> int:
+        return max(1, int(os.getenv("LLM_BREAKER_FAILURES", "3")))
+
+    def _base_cooldown(self) -> float:
+        return float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+    def _max_cooldown(self) -> float:
+        return float(os.getenv("LLM_BREAKER_MAX_COOLDOWN", "300"))
+
+    def _retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def _refusal(self) -> Optional[str]:
+        # Called with the lock held on a non-closed breaker: why a call is refused now (None = allowed).
+        if self.state == "open" and self._retry_in() > 0:
+            return f"{self.name} circuit open (retry in {self._retry_in():.0f}s)"
+        if self._probing:
+            return f"{self.name} circuit half-open (probe in flight)"
+        return None
+
+    def _acquire(self) -> None:
+        with self._lock:
+            if self.state == "closed":
+                return
+            refusal = self._refusal()
+            if refusal:
+                raise CircuitOpen(refusal)
+            self.state = "half_open"
+            self._probing = True
+
+    def check(self) -> None:
+        """Raise CircuitOpen if a call would be refused right now, without taking the probe slot."""
+        with self._lock:
+            refusal = self._refusal() if self.state != "closed" else None
+        if refusal:
+            raise CircuitOpen(refusal)
+
+    def _success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.cooldown = 0.0
+            self._probing = False
+
+    def _failure(self, exc: Exception) -> None:
+        status, resp = _http_error(exc)
+        retry_after = _retry_after(resp) if status == 429 else 0.0
+        with self._lock:
+            self._probing = False
+            self.failures += 1
+            self.last_error = f"{type(exc).__name__}: {str(exc).strip().splitlines()[0] if str(exc).strip() else ''}"[:200]
+            if self.state == "half_open":
+                self._trip(min(self._max_cooldown(), max(self.cooldown * 2, self._base_cooldown())), retry_after)
+            elif status == 429 or self.failures >= self._threshold():
+                self._trip(self._base_cooldown(), retry_after)
+
+    def _trip(self, cooldown: float, retry_after: float) -> None:
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.cooldown = max(cooldown, retry_after)
+        self.trips += 1
+
+    def _release(self) -> None:
+        # Cancelled / abandoned call: neither success nor failure, just free the probe slot.
+        with self._lock:
+            self._probing = False
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        """Wrap one provider call (sync, async or a whole stream iteration)."""
+        self._acquire()
+        try:
+            yield
+        except Exception as e:
+            self._failure(e)
+            raise
+        except BaseException:
+            self._release()
+            raise
+        else:
+            self._success()
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            state = self.state
+            if state == "open" and self._retry_in() <= 0:
+                state = "half_open"
+            return {
+                "state": state,
+                "consecutiveFailures": self.failures,
+                "cooldownSeconds": round(self.cooldown, 1),
+                "retryInSeconds": round(self._retry_in(), 1) if self.state == "open" else 0.0,
+                "trips": self.trips,
+                "lastError": self.last_error or None,
+            }
+
+
+# Process-wide (FallbackLLM / MistralClient are recreated per request).
+_breakers: Dict[str, CircuitBreaker] = {}
+_registry_lock = threading.Lock()
+
+
+def breaker(provider: str) -> CircuitBreaker:
+    with _registry_lock:
+        b = _breakers.get(provider)
+        if b is None:
+            b = _breakers[provider] = CircuitBreaker(provider)
+        return b
+
+
+def breaker_status() -> Dict[str, Dict[str, Any]]:
+    with _registry_lock:
+        items = sorted(_breakers.items())
+    return {name: b.status() for name, b in items}
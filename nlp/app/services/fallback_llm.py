@@ -1,10 +1,17 @@
 from __future__ import annotations
 
+import json
 import os
-from typing import Literal, Optional
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Literal, Optional, Tuple
 
 import requests
 
+from app.services import llm_batch
+from app.services.circuit_breaker import breaker
+from app.services.http_pool import openai_delta_text, provider_async_client, provider_session, sse_data
+from app.services.rate_limit import limiter
+
 
 Provider = Literal["openai", "gemini"]
 
@@ -44,6 +51,9 @@ class FallbackLLM:
             elif self.openai_api_key:
                 self.provider = "openai"
 
+        # Instances are cheap (env snapshot); the pooled keep-alive session is process-wide.
+        self._session = provider_session(self.provider or "default")
+
     def available(self) -> bool:
         if self.provider == "openai":
             return bool(self.openai_api_key)
@@ -51,19 +61,46 @@ class FallbackLLM:
             return bool(self.gemini_api_key)
         return False
 
+    def _check_provider(self) -> None:
+        if self.provider not in ("openai", "gemini"):
+            raise RuntimeError("FALLBACK_LLM_PROVIDER not configured")
+
+    @contextmanager
+    def _guard(self, prompt: str) -> Iterator[None]:
+        # Every call waits for the provider's quota (rate_limit.py), then goes through
+        # its circuit breaker (circuit_breaker.py). Both are process-wide.
+        self._check_provider()
+        with limiter(self.provider).hold(prompt), breaker(self.provider).guard():
+            yield
+
+    @asynccontextmanager
+    async def _guard_async(self, prompt: str) -> AsyncIterator[None]:
+        self._check_provider()
+        async with limiter(self.provider).hold_async(prompt):
+            with breaker(self.provider).guard():
+                yield
+
+    async def _guarded_stream(self, prompt: str, deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+        async with self._guard_async(prompt):
+            async for text in deltas:
+                yield text
+
     def complete(self, *, lang: Literal["ar", "en"], user_message: str) -> str:
-        if self.provider == "openai":
-            return self._openai_chat(lang=lang, user_message=user_message)
-        if self.provider == "gemini":
+        with self._guard(self._general_prompt(lang, user_message)):
+            if self.provider == "openai":
+                return self._openai_chat(lang=lang, user_message=user_message)
             return self._gemini_generate(lang=lang, user_message=user_message)
-        raise RuntimeError("FALLBACK_LLM_PROVIDER not configured")
 
-    def answer_with_sources(
-        self, *, lang: Literal["ar", "en"], question: str, sources_text: str
-    ) -> str:
-        """
-        Generate an answer grounded in sources (RAG-style).
-        """
+    async def complete_async(self, *, lang: Literal["ar", "en"], user_message: str) -> str:
+        async def call() -> str:
+            async with self._guard_async(self._general_prompt(lang, user_message)):
+                if self.provider == "openai":
+                    return await self._openai_chat_custom_async(system=self._system_prompt(lang), user=user_message)
+                return await self._gemini_call_async(self._gemini_payload(self._general_prompt(lang, user_message)))
+
+        return await llm_batch.submit(self.provider, ("general", lang, user_message), call)
+
+    def _rag_prompt(self, question: str, sources_text: str) -> Tuple[str, str]:
         system = (
             "You are a university student-services assistant. "
             "Answer ONLY using the provided sources. "
@@ -78,11 +115,51 @@ class FallbackLLM:
             f"Question:\n{question}\n\nSources:\n{sources_text}\n\n"
             "Return a concise professional answer and cite sources like [1], [2] when relevant."
         )
-        if self.provider == "openai":
-            return self._openai_chat_custom(system=system, user=user)
-        if self.provider == "gemini":
+        return system, user
+
+    def answer_with_sources(
+        self, *, lang: Literal["ar", "en"], question: str, sources_text: str
+    ) -> str:
+        """
+        Generate an answer grounded in sources (RAG-style).
+        """
+        system, user = self._rag_prompt(question, sources_text)
+        with self._guard(f"{system}\n\n{user}"):
+            if self.provider == "openai":
+                return self._openai_chat_custom(system=system, user=user)
             return self._gemini_generate_custom(prompt=f"{system}\n\n{user}")
-        raise RuntimeError("FALLBACK_LLM_PROVIDER not configured")
+
+    async def answer_with_sources_async(
+        self, *, lang: Literal["ar", "en"], question: str, sources_text: str
+    ) -> str:
+        system, user = self._rag_prompt(question, sources_text)
+
+        async def call() -> str:
+            async with self._guard_async(f"{system}\n\n{user}"):
+                if self.provider == "openai":
+                    return await self._openai_chat_custom_async(system=system, user=user)
+                return await self._gemini_call_async(self._gemini_payload(f"{system}\n\n{user}"))
+
+        # Optional microbatching (llm_batch.py): identical prompts in one window share a call.
+        return await llm_batch.submit(self.provider, ("rag", system, user), call)
+
+    # --- streaming (text deltas, used by /api/chat/stream) ---
+    def complete_stream(self, *, lang: Literal["ar", "en"], user_message: str) -> AsyncIterator[str]:
+        self._check_provider()
+        prompt = self._general_prompt(lang, user_message)
+        if self.provider == "openai":
+            return self._guarded_stream(prompt, self._openai_stream(system=self._system_prompt(lang), user=user_message))
+        return self._guarded_stream(prompt, self._gemini_stream(self._gemini_payload(prompt)))
+
+    def answer_with_sources_stream(
+        self, *, lang: Literal["ar", "en"], question: str, sources_text: str
+    ) -> AsyncIterator[str]:
+        self._check_provider()
+        system, user = self._rag_prompt(question, sources_text)
+        prompt = f"{system}\n\n{user}"
+        if self.provider == "openai":
+            return self._guarded_stream(prompt, self._openai_stream(system=system, user=user))
+        return self._guarded_stream(prompt, self._gemini_stream(self._gemini_payload(prompt)))
 
     def _system_prompt(self, lang: Literal["ar", "en"]) -> str:
         if lang == "ar":
@@ -101,35 +178,14 @@ class FallbackLLM:
             "If you need clarification, ask only ONE clarifying question."
         )
 
-    def _openai_chat(self, *, lang: Literal["ar", "en"], user_message: str) -> str:
+    def _openai_request(self, system: str, user: str) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
         if not self.openai_api_key:
             raise RuntimeError("OPENAI_API_KEY not set")
         url = f"{self.openai_base_url}/v1/chat/completions"
-        payload = {
-            "model": self.openai_model,
-            "messages": [
-                {"role": "system", "content": self._system_prompt(lang)},
-                {"role": "user", "content": user_message},
-            ],
-            "temperature": 0.2,
+        headers = {
+            "Authorization": f"Bearer {self.openai_api_key}",
+            "Content-Type": "application/json",
         }
-        r = requests.post(
-            url,
-            headers={
-                "Authorization": f"Bearer {self.openai_api_key}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=60,
-        )
-        r.raise_for_status()
-        data = r.json()
-        return str(data["choices"][0]["message"]["content"])
-
-    def _openai_chat_custom(self, *, system: str, user: str) -> str:
-        if not self.openai_api_key:
-            raise RuntimeError("OPENAI_API_KEY not set")
-        url = f"{self.openai_base_url}/v1/chat/completions"
         payload = {
             "model": self.openai_model,
             "messages": [
@@ -138,159 +194,318 @@ class FallbackLLM:
             ],
             "temperature": 0.2,
         }
-        r = requests.post(
-            url,
-            headers={
-                "Authorization": f"Bearer {self.openai_api_key}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=60,
-        )
+        return url, headers, payload
+
+    def _openai_chat(self, *, lang: Literal["ar", "en"], user_message: str) -> str:
+        return self._openai_chat_custom(system=self._system_prompt(lang), user=user_message)
+
+    def _openai_chat_custom(self, *, system: str, user: str) -> str:
+        url, headers, payload = self._openai_request(system, user)
+        r = self._session.post(url, headers=headers, json=payload, timeout=60)
         r.raise_for_status()
         data = r.json()
         return str(data["choices"][0]["message"]["content"])
 
-    def _gemini_generate(self, *, lang: Literal["ar", "en"], user_message: str) -> str:
-        if not self.gemini_api_key:
-            raise RuntimeError("GEMINI_API_KEY not set")
+    async def _openai_chat_custom_async(self, *, system: str, user: str) -> str:
+        url, headers, payload = self._openai_request(system, user)
+        r = await provider_async_client(self.provider).post(url, headers=headers, json=payload, timeout=60)
+        r.raise_for_status()
+        data = r.json()
+        return str(data["choices"][0]["message"]["content"])
 
-        # Try a few common model name variants because Gemini model names differ by account/region.
-        # Users can also discover valid names with: GET /v1beta/models?key=...
-        def normalize_model_name(x: str) -> str:
-            x = (x or "").strip()
-            if x.startswith("models/"):
-                return x[len("models/") :]
-            return x
+    async def _openai_stream(self, *, system: str, user: str) -> AsyncIterator[str]:
+        url, headers, payload = self._openai_request(system, user)
+        payload["stream"] = True
+        async with provider_async_client(self.provider).stream(
+            "POST", url, headers=headers, json=payload, timeout=60
+        ) as r:
+            r.raise_for_status()
+            async for data in sse_data(r):
+                if data == "[DONE]":
+                    break
+                text = openai_delta_text(data)
+                if text:
+                    yield text
 
-        candidates: list[str] = []
-        m = normalize_model_name(self.gemini_model.strip())
-        if m:
-            candidates.append(m)
-        # Common variants (safe to try)
-        for v in [
-            "gemini-2.5-flash",
-            "gemini-2.5-flash-lite",
-            "gemini-2.0-flash",
-            "gemini-2.0-flash-lite",
-            "gemini-2.0-flash-lite-001",
-            "gemini-2.5-pro",
-        ]:
-            if v not in candidates:
-                candidates.append(v)
+    def _general_prompt(self, lang: Literal["ar", "en"], user_message: str) -> str:
+        return f"{self._system_prompt(lang)}\n\nUser: {user_message}"
 
-        payload = {
-            "contents": [
-                {
-                    "role": "user",
-                    "parts": [{"text": f"{self._system_prompt(lang)}\n\nUser: {user_message}"}],
-                }
-            ]
-        }
-
-        def version_candidates() -> list[str]:
-            if self.gemini_api_version in ("v1", "v1beta"):
-                return [self.gemini_api_version]
-            # auto
-            return ["v1beta", "v1"]
+    def _gemini_payload(self, prompt: str) -> Dict[str, Any]:
+        return {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
 
-        last_err: Exception | None = None
-        for api_version in version_candidates():
-            for model_name in candidates:
-                url = f"{self.gemini_base_url}/{api_version}/models/{model_name}:generateContent"
-                try:
-                    r = requests.post(url, params={"key": self.gemini_api_key}, json=payload, timeout=60)
-                    if r.status_code == 404:
-                        last_err = requests.HTTPError(
-                            f"404 Not Found for model '{model_name}' on {api_version}. "
-                            f"Try listing models via {self.gemini_base_url}/{api_version}/models?key=YOUR_KEY"
-                        )
-                        continue
-                    r.raise_for_status()
-                    data = r.json()
-                    break
-                except Exception as e:
-                    last_err = e
-                    continue
-            else:
-                # tried all models for this version
-                continue
-            # success
-            break
-        else:
-            raise RuntimeError(f"Gemini request failed. Last error: {last_err}")
-
-        candidates = data.get("candidates") or []
-        if not candidates:
-            raise RuntimeError("Gemini returned no candidates")
-        content = candidates[0].get("content") or {}
-        parts = content.get("parts") or []
-        if not parts:
-            raise RuntimeError("Gemini returned empty content parts")
-        return str(parts[0].get("text") or "")
+    def _gemini_generate(self, *, lang: Literal["ar", "en"], user_message: str) -> str:
+        return self._gemini_call(self._gemini_payload(self._general_prompt(lang, user_message)))
 
     def _gemini_generate_custom(self, *, prompt: str) -> str:
         """
         Same as _gemini_generate but with a custom prompt (already contains system + user + sources).
         """
-        if not self.gemini_api_key:
-            raise RuntimeError("GEMINI_API_KEY not set")
+        return self._gemini_call(self._gemini_payload(prompt))
+
+    # --- Gemini model / API-version resolution ---
+    def _gemini_cache_key(self) -> Tuple[str, str, str, str]:
+        return (self.gemini_base_url, self.gemini_api_key, self.gemini_model, self.gemini_api_version)
+
+    def gemini_resolved(self) -> Optional[Tuple[str, str]]:
+        """(api_version, model) that last worked for this config in this process, if any."""
+        return _gemini_resolved.get(self._gemini_cache_key())
 
-        def normalize_model_name(x: str) -> str:
-            x = (x or "").strip()
-            if x.startswith("models/"):
-                return x[len("models/") :]
-            return x
+    def _gemini_version_candidates(self) -> list[str]:
+        if self.gemini_api_version in ("v1", "v1beta"):
+            return [self.gemini_api_version]
+        # auto
+        return ["v1beta", "v1"]
 
+    def _gemini_model_candidates(self) -> list[str]:
+        # Try a few common model name variants because Gemini model names differ by account/region.
+        # Users can also discover valid names with: GET /v1beta/models?key=...
         candidates: list[str] = []
-        m = normalize_model_name(self.gemini_model.strip())
+        m = _normalize_model_name(self.gemini_model)
         if m:
             candidates.append(m)
-        for v in [
-            "gemini-2.5-flash",
-            "gemini-2.5-flash-lite",
-            "gemini-2.0-flash",
-            "gemini-2.0-flash-lite",
-            "gemini-2.0-flash-lite-001",
-            "gemini-2.5-pro",
-        ]:
+        # Common variants (safe to try)
+        for v in _GEMINI_FALLBACK_MODELS:
             if v not in candidates:
                 candidates.append(v)
+        return candidates
 
-        def version_candidates() -> list[str]:
-            if self.gemini_api_version in ("v1", "v1beta"):
-                return [self.gemini_api_version]
-            return ["v1beta", "v1"]
+    def _gemini_list_models(self, api_version: str) -> Optional[set[str]]:
+        """
+        Names supporting generateContent on this API version (same listing endpoint as
+        tools/list_gemini_models.py), or None if the listing isn't available.
+        """
+        try:
+            r = self._session.get(
+                f"{self.gemini_base_url}/{api_version}/models", params={"key": self.gemini_api_key}, timeout=30
+            )
+            r.raise_for_status()
+            return _gemini_generate_models(r.json())
+        except Exception:
+            return None
+
+    async def _gemini_list_models_async(self, api_version: str) -> Optional[set[str]]:
+        try:
+            r = await provider_async_client("gemini").get(
+                f"{self.gemini_base_url}/{api_version}/models", params={"key": self.gemini_api_key}, timeout=30
+            )
+            r.raise_for_status()
+            return _gemini_generate_models(r.json())
+        except Exception:
+            return None
+
+    def _gemini_listing_keys(self) -> list[Tuple[str, str, str]]:
+        # Versions whose listing hasn't been fetched yet; empty unless GEMINI_DISCOVER_MODELS is on.
+        if (os.getenv("GEMINI_DISCOVER_MODELS") or "").strip().lower() not in ("1", "true", "yes"):
+            return []
+        keys = [(self.gemini_base_url, self.gemini_api_key, v) for v in self._gemini_version_candidates()]
+        return [k for k in keys if k not in _gemini_listed]
+
+    def _gemini_known_attempts(self) -> list[Tuple[str, str]]:
+        attempts = [(v, m) for v in self._gemini_version_candidates() for m in self._gemini_model_candidates()]
+        # Optional discovery: probe only pairs the (cached) listing says exist.
+        if (os.getenv("GEMINI_DISCOVER_MODELS") or "").strip().lower() in ("1", "true", "yes"):
+            listed = {v: _gemini_listed.get((self.gemini_base_url, self.gemini_api_key, v)) for v, _ in attempts}
+            known = [(v, m) for v, m in attempts if listed[v] is None or m in listed[v]]
+            if known:
+                attempts = known
+        return attempts
+
+    def _gemini_attempts(self) -> list[Tuple[str, str]]:
+        for key in self._gemini_listing_keys():
+            _gemini_listed[key] = self._gemini_list_models(key[2])
+        return self._gemini_known_attempts()
+
+    async def _gemini_attempts_async(self) -> list[Tuple[str, str]]:
+        for key in self._gemini_listing_keys():
+            _gemini_listed[key] = await self._gemini_list_models_async(key[2])
+        return self._gemini_known_attempts()
+
+    def _gemini_post(self, api_version: str, model_name: str, payload: Dict[str, Any]) -> str:
+        url = f"{self.gemini_base_url}/{api_version}/models/{model_name}:generateContent"
+        r = self._session.post(url, params={"key": self.gemini_api_key}, json=payload, timeout=60)
+        if r.status_code == 404:
+            raise _GeminiNotFound(
+                f"404 Not Found for model '{model_name}' on {api_version}. "
+                f"Try listing models via {self.gemini_base_url}/{api_version}/models?key=YOUR_KEY"
+            )
+        r.raise_for_status()
+        return _gemini_text(r.json())
 
-        payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    def _gemini_call(self, payload: Dict[str, Any]) -> str:
+        if not self.gemini_api_key:
+            raise RuntimeError("GEMINI_API_KEY not set")
 
+        key = self._gemini_cache_key()
         last_err: Exception | None = None
-        for api_version in version_candidates():
-            for model_name in candidates:
-                url = f"{self.gemini_base_url}/{api_version}/models/{model_name}:generateContent"
-                try:
-                    r = requests.post(url, params={"key": self.gemini_api_key}, json=payload, timeout=60)
-                    if r.status_code == 404:
-                        last_err = requests.HTTPError(
-                            f"404 Not Found for model '{model_name}' on {api_version}. "
-                            f"Try listing models via {self.gemini_base_url}/{api_version}/models?key=YOUR_KEY"
-                        )
-                        continue
-                    r.raise_for_status()
-                    data = r.json()
-                    candidates_resp = data.get("candidates") or []
-                    if not candidates_resp:
-                        raise RuntimeError("Gemini returned no candidates")
-                    content = candidates_resp[0].get("content") or {}
-                    parts = content.get("parts") or []
-                    if not parts:
-                        raise RuntimeError("Gemini returned empty content parts")
-                    return str(parts[0].get("text") or "")
-                except Exception as e:
-                    last_err = e
-                    continue
-        raise RuntimeError(f"Gemini request failed. Last error: {last_err}")
-
+        cached = _gemini_resolved.get(key)
+        if cached:
+            try:
+                return self._gemini_post(*cached, payload)
+            except _GeminiNotFound as e:
+                # The remembered pair went away: forget it and probe again.
+                _gemini_resolved.pop(key, None)
+                last_err = e
+            except Exception as e:
+                # Quota / 5xx on the remembered pair: try the others, but keep remembering it.
+                last_err = e
+
+        for api_version, model_name in self._gemini_attempts():
+            if (api_version, model_name) == cached:
+                continue
+            try:
+                text = self._gemini_post(api_version, model_name, payload)
+            except Exception as e:
+                last_err = e
+                continue
+            _gemini_resolved.setdefault(key, (api_version, model_name))
+            return text
+        raise RuntimeError(f"Gemini request failed. Last error: {last_err}") from last_err
+
+    async def _gemini_post_async(self, api_version: str, model_name: str, payload: Dict[str, Any]) -> str:
+        url = f"{self.gemini_base_url}/{api_version}/models/{model_name}:generateContent"
+        r = await provider_async_client("gemini").post(
+            url, params={"key": self.gemini_api_key}, json=payload, timeout=60
+        )
+        if r.status_code == 404:
+            raise _GeminiNotFound(
+                f"404 Not Found for model '{model_name}' on {api_version}. "
+                f"Try listing models via {self.gemini_base_url}/{api_version}/models?key=YOUR_KEY"
+            )
+        r.raise_for_status()
+        return _gemini_text(r.json())
 
+    async def _gemini_call_async(self, payload: Dict[str, Any]) -> str:
+        # Async twin of _gemini_call (same resolution cache).
+        if not self.gemini_api_key:
+            raise RuntimeError("GEMINI_API_KEY not set")
 
+        key = self._gemini_cache_key()
+        last_err: Exception | None = None
+        cached = _gemini_resolved.get(key)
+        if cached:
+            try:
+                return await self._gemini_post_async(*cached, payload)
+            except _GeminiNotFound as e:
+                _gemini_resolved.pop(key, None)
+                last_err = e
+            except Exception as e:
+                last_err = e
+
+        for api_version, model_name in await self._gemini_attempts_async():
+            if (api_version, model_name) == cached:
+                continue
+            try:
+                text = await self._gemini_post_async(api_version, model_name, payload)
+            except Exception as e:
+                last_err = e
+                continue
+            _gemini_resolved.setdefault(key, (api_version, model_name))
+            return text
+        raise RuntimeError(f"Gemini request failed. Last error: {last_err}") from last_err
+
+    async def _gemini_stream_attempts(self, cached: Optional[Tuple[str, str]]) -> AsyncIterator[Tuple[str, str]]:
+        if cached:
+            yield cached
+        for attempt in await self._gemini_attempts_async():
+            if attempt != cached:
+                yield attempt
+
+    async def _gemini_stream(self, payload: Dict[str, Any]) -> AsyncIterator[str]:
+        """
+        streamGenerateContent (SSE) with the same version/model resolution as _gemini_call.
+        Falling through to the next pair only happens before the first chunk is yielded.
+        """
+        if not self.gemini_api_key:
+            raise RuntimeError("GEMINI_API_KEY not set")
 
+        client = provider_async_client("gemini")
+        key = self._gemini_cache_key()
+        last_err: Exception | None = None
+        cached = _gemini_resolved.get(key)
+        async for api_version, model_name in self._gemini_stream_attempts(cached):
+            url = f"{self.gemini_base_url}/{api_version}/models/{model_name}:streamGenerateContent"
+            request = client.build_request(
+                "POST", url, params={"key": self.gemini_api_key, "alt": "sse"}, json=payload, timeout=60
+            )
+            r = None
+            try:
+                r = await client.send(request, stream=True)
+                if r.status_code == 404:
+                    raise _GeminiNotFound(f"404 Not Found for model '{model_name}' on {api_version}.")
+                r.raise_for_status()
+            except Exception as e:
+                if r is not None:
+                    await r.aclose()
+                if isinstance(e, _GeminiNotFound) and (api_version, model_name) == cached:
+                    _gemini_resolved.pop(key, None)
+                last_err = e
+                continue
+            _gemini_resolved.setdefault(key, (api_version, model_name))
+            try:
+                async for data in sse_data(r):
+                    text = _gemini_chunk_text(json.loads(data))
+                    if text:
+                        yield text
+            finally:
+                await r.aclose()
+            return
+        raise RuntimeError(f"Gemini request failed. Last error: {last_err}") from last_err
+
+
+class _GeminiNotFound(requests.HTTPError):
+    pass
+
+
+_GEMINI_FALLBACK_MODELS = [
+    "gemini-2.5-flash",
+    "gemini-2.5-flash-lite",
+    "gemini-2.0-flash",
+    "gemini-2.0-flash-lite",
+    "gemini-2.0-flash-lite-001",
+    "gemini-2.5-pro",
+]
+
+# (base_url, api_key, configured model, configured api version) -> first working (api_version, model).
+# Process-wide so per-request FallbackLLM instances share it; invalidated on 404 (or a config change,
+# which yields a different key).
+_gemini_resolved: Dict[Tuple[str, str, str, str], Tuple[str, str]] = {}
+
+# (base_url, api_key, api_version) -> model names the listing endpoint reported (None: listing failed).
+# Fetched once per process when GEMINI_DISCOVER_MODELS is on, so an empty _gemini_resolved (cold start,
+# or after a 404) never triggers another listing round-trip.
+_gemini_listed: Dict[Tuple[str, str, str], Optional[set[str]]] = {}
+
+
+def _gemini_generate_models(data: Dict[str, Any]) -> set[str]:
+    return {
+        _normalize_model_name(str(m.get("name") or ""))
+        for m in data.get("models") or []
+        if "generateContent" in (m.get("supportedGenerationMethods") or [])
+    }
+
+
+def _normalize_model_name(x: str) -> str:
+    x = (x or "").strip()
+    if x.startswith("models/"):
+        return x[len("models/") :]
+    return x
+
+
+def _gemini_text(data: Dict[str, Any]) -> str:
+    candidates = data.get("candidates") or []
+    if not candidates:
+        raise RuntimeError("Gemini returned no candidates")
+    content = candidates[0].get("content") or {}
+    parts = content.get("parts") or []
+    if not parts:
+        raise RuntimeError("Gemini returned empty content parts")
+    return str(parts[0].get("text") or "")
+
+
+def _gemini_chunk_text(data: Dict[str, Any]) -> str:
+    # Streamed chunks may carry no parts (e.g. the final one with only finishReason).
+    candidates = data.get("candidates") or []
+    if not candidates:
+        return ""
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(str(p.get("text") or "") for p in parts)
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import threading
+from typing import AsyncIterator, Dict, Tuple
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+_sessions: Dict[Tuple[int, str], requests.Session] = {}
+_async_clients: Dict[Tuple[int, int, str], httpx.AsyncClient] = {}
+_lock = threading.Lock()
+
+
+def pool_size() -> int:
+    return int(os.getenv("LLM_HTTP_POOL_SIZE", "10"))
+
+
+def provider_session(provider: str) -> requests.Session:
+    """
+    Long-lived keep-alive session for one LLM provider ("openai" | "gemini" | "mistral").
+    Created once per process (keyed by pid, so forked workers don't share sockets) and reused
+    by every client instance, so calls skip the TCP+TLS handshake.
+    Pool size: LLM_HTTP_POOL_SIZE (max idle connections kept per host).
+    """
+    key = (os.getpid(), provider)
+    s = _sessions.get(key)
+    if s is not None:
+        return s
+    with _lock:
+        s = _sessions.get(key)
+        if s is None:
+            s = requests.Session()
+            size = pool_size()
+            adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _sessions[key] = s
+        return s
+
+
+def provider_async_client(provider: str) -> httpx.AsyncClient:
+    """
+    Async counterpart of provider_session: one pooled keep-alive httpx client per provider,
+    process and event loop (an AsyncClient can't be shared across loops).
+    """
+    key = (os.getpid(), id(asyncio.get_running_loop()), provider)
+    c = _async_clients.get(key)
+    if c is None:
+        size = pool_size()
+        c = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=size),
+            timeout=60,
+        )
+        _async_clients[key] = c
+    return c
+
+
+async def close_async_clients() -> None:
+    loop_id = id(asyncio.get_running_loop())
+    for key in [k for k in _async_clients if k[1] == loop_id]:
+        await _async_clients.pop(key).aclose()
+
+
+async def sse_data(response: httpx.Response) -> AsyncIterator[str]:
+    """`data:` payloads of a server-sent events response (OpenAI/Mistral/Gemini streaming)."""
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            yield line[5:].strip()
+
+
+def openai_delta_text(data: str) -> str:
+    # Chat-completions stream chunk (OpenAI-compatible, also used by Mistral).
+    choices = json.loads(data).get("choices") or []
+    if not choices:
+        return ""
+    return str((choices[0].get("delta") or {}).get("content") or "")
@@ -1,9 +1,27 @@
 from __future__ import annotations
 
+import hashlib
+import io
 import json
 import os
-from dataclasses import dataclass
-from typing import List, Optional
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+_Q_LINE_RE = re.compile(r"(?mi)^\s*Q:\s*(.+)$")
+_A_LINE_RE = re.compile(r"(?mi)^\s*A:\s*(.+)$")
+
+
+def split_qa(text: str) -> Tuple[str, str]:
+    """
+    Our KB entries often look like:
+      Q: ...
+      A: ...
+    Returns (question, answer): the Q line ("" when absent) and the A line (the whole text when absent).
+    """
+    q = _Q_LINE_RE.search(text or "")
+    a = _A_LINE_RE.search(text or "")
+    return (q.group(1).strip() if q else ""), (a.group(1).strip() if a else (text or "").strip())
 
 
 @dataclass
@@ -13,6 +31,12 @@ class KBItem:
     url: str
     type: str
     text: str
+    # Parsed once when the item is loaded (see split_qa); derived from `text`.
+    question: str = field(default="", init=False, repr=False, compare=False)
+    answer: str = field(default="", init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.question, self.answer = split_qa(self.text)
 
 
 def _default_kb_items() -> List[KBItem]:
@@ -69,38 +93,111 @@ def resolve_kb_path(data_dir: str) -> Optional[str]:
     return None
 
 
-def load_kb(data_dir: str) -> List[KBItem]:
+def kb_version(path: Optional[str]) -> str:
     """
-    Loads knowledge base from /app/data/kb.jsonl (recommended) or falls back to a seeded KB.
-
-    Expected jsonl format (one object per line):
-      {"id":"...", "title":"...", "url":"...", "type":"official|faq|policy", "text":"..."}
+    Short content hash of the KB file (same across restarts and workers), used to key caches.
+    "default_seed" for the built-in KB.
     """
-    path = resolve_kb_path(data_dir)
     if not path:
-        return _default_kb_items()
-
+        return "default_seed"
+    h = hashlib.sha1()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    except OSError:
+        return ""
+    return h.hexdigest()[:16]
+
+
+def _item_from_obj(obj: dict) -> KBItem:
+    return KBItem(
+        id=str(obj.get("id") or ""),
+        title=str(obj.get("title") or "Source"),
+        url=str(obj.get("url") or ""),
+        type=str(obj.get("type") or "official"),
+        text=str(obj.get("text") or ""),
+    )
+
+
+def iter_kb_records(path: str) -> Iterator[Tuple[int, int, KBItem]]:
+    """
+    Yields (byte offset, byte length, item) for each non-empty KB line.
+    Items with empty text are skipped (same as load_kb).
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    return parse_kb_records(data)
+
+
+def parse_kb_records(data: bytes) -> Iterator[Tuple[int, int, KBItem]]:
+    """iter_kb_records over the jsonl content already read into memory."""
+    offset = 0
+    for raw in io.BytesIO(data):
+        start = offset
+        offset += len(raw)
+        line = raw.decode("utf-8").strip()
+        if not line:
+            continue
+        it = _item_from_obj(json.loads(line))
+        if it.text.strip():
+            yield start, len(raw), it
+
+
+def read_kb(path: str, known: Optional[Dict[bytes, KBItem]] = None) -> Tuple[List[KBItem], Dict[bytes, KBItem], str]:
+    """
+    Reads the KB file in one pass: (items, {jsonl line: item}, kb_version).
+    A line already in `known` (the previous read's table) reuses that item object as is,
+    so a reload only parses the lines that were added or edited.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    known = known or {}
     items: List[KBItem] = []
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
+    lines: Dict[bytes, KBItem] = {}
+    for raw in data.split(b"\n"):
+        it = known.get(raw) or lines.get(raw)
+        if it is None:
+            line = raw.decode("utf-8").strip()
             if not line:
                 continue
-            obj = json.loads(line)
-            items.append(
-                KBItem(
-                    id=str(obj.get("id") or ""),
-                    title=str(obj.get("title") or "Source"),
-                    url=str(obj.get("url") or ""),
-                    type=str(obj.get("type") or "official"),
-                    text=str(obj.get("text") or ""),
-                )
-            )
-    # Drop empty texts
-    return [it for it in items if it.text.strip()]
+            it = _item_from_obj(json.loads(line))
+            if not it.text.strip():
+                continue
+        lines[raw] = it
+        items.append(it)
+    return items, lines, hashlib.sha1(data).hexdigest()[:16]
 
 
+def kb_changes(
+    old: Tuple[Sequence[KBItem], Dict[bytes, KBItem]], new: Tuple[Sequence[KBItem], Dict[bytes, KBItem]]
+) -> Optional[Tuple[List[KBItem], List[KBItem]]]:
+    """
+    (removed, added) items between two read_kb results (items, lines), in file order.
+    None when that can't be told from the line tables: a read with repeated lines, or
+    items that didn't come from read_kb (e.g. a prebuilt index).
+    """
+    (old_items, old_lines), (new_items, new_lines) = old, new
+    if len(old_items) != len(old_lines) or len(new_items) != len(new_lines):
+        return None
+    removed = [it for raw, it in old_lines.items() if raw not in new_lines]
+    added = [it for raw, it in new_lines.items() if raw not in old_lines]
+    return removed, added
 
 
+def read_kb_record(buf, offset: int, length: int) -> KBItem:
+    """Parses one KB line from a bytes-like view of jsonl content."""
+    return _item_from_obj(json.loads(bytes(buf[offset : offset + length]).decode("utf-8")))
 
 
+def load_kb(data_dir: str) -> List[KBItem]:
+    """
+    Loads knowledge base from /app/data/kb.jsonl (recommended) or falls back to a seeded KB.
+
+    Expected jsonl format (one object per line):
+      {"id":"...", "title":"...", "url":"...", "type":"official|faq|policy", "text":"..."}
+    """
+    path = resolve_kb_path(data_dir)
+    if not path:
+        return _default_kb_items()
+    return [it for _, _, it in iter_kb_records(path)]
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from app.services.metrics import BATCH_REQUESTS, BATCH_SIZE
+from app.services.rate_limit import TokenBucket
+
+Call = Callable[[], Awaitable[str]]
+
+
+def enabled() -> bool:
+    """LLM_MICROBATCH=1 turns the scheduler on (off by default: calls go straight to the provider)."""
+    return (os.getenv("LLM_MICROBATCH") or "0").strip().lower() in ("1", "true", "yes")
+
+
+def _window() -> float:
+    return max(0.0, float(os.getenv("LLM_MICROBATCH_WINDOW_MS", "10"))) / 1000.0
+
+
+def _max_batch() -> int:
+    return max(1, int(os.getenv("LLM_MICROBATCH_MAX", "16")))
+
+
+def _concurrency() -> int:
+    return max(1, int(os.getenv("LLM_MICROBATCH_CONCURRENCY", "8")))
+
+
+# Request-rate buckets are per provider and process-wide (every event loop shares the quota).
+_buckets: Dict[str, Optional[TokenBucket]] = {}
+_batchers: Dict[Tuple[int, str], "MicroBatcher"] = {}
+_lock = threading.Lock()
+
+
+def _bucket(provider: str) -> Optional[TokenBucket]:
+    with _lock:
+        if provider not in _buckets:
+            rps = float(os.getenv("LLM_MICROBATCH_RPS", "0"))
+            burst = float(os.getenv("LLM_MICROBATCH_BURST") or rps)
+            _buckets[provider] = TokenBucket(rps, burst) if rps > 0 else None
+        return _buckets[provider]
+
+
+class _Group:
+    """One distinct prompt in a batch and the callers waiting for its answer."""
+
+    __slots__ = ("call", "waiters", "task")
+
+    def __init__(self, call: Call):
+        self.call = call
+        self.waiters: List[asyncio.Future] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def abandoned(self) -> bool:
+        return all(w.done() for w in self.waiters)
+
+
+class MicroBatcher:
+    """
+    Collects calls to one provider for LLM_MICROBATCH_WINDOW_MS (or until LLM_MICROBATCH_MAX distinct
+    prompts are queued), then dispatches the batch: identical prompts are sent once and the answer is
+    fanned out, and the calls run through a pool of LLM_MICROBATCH_CONCURRENCY slots paced by the
+    provider's token bucket (LLM_MICROBATCH_RPS). One instance per provider and event loop.
+    """
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self._loop = asyncio.get_running_loop()
+        self._groups: "OrderedDict[Hashable, _Group]" = OrderedDict()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._slots = asyncio.Semaphore(_concurrency())
+        self._stats = {"requests": 0, "batches": 0, "calls": 0, "deduplicated": 0, "queued": 0}
+
+    async def submit(self, key: Hashable, call: Call) -> str:
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _Group(call)
+        else:
+            self._stats["deduplicated"] += 1
+            BATCH_REQUESTS.inc(provider=self.provider, result="deduplicated")
+        waiter = self._loop.create_future()
+        waiter.add_done_callback(lambda _w: self._abandon(group))
+        group.waiters.append(waiter)
+        self._stats["requests"] += 1
+        if len(self._groups) >= _max_batch():
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(_window(), self._flush)
+        return await waiter
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        groups = [g for g in self._groups.values() if not g.abandoned()]
+        self._groups.clear()
+        if not groups:
+            return
+        self._stats["batches"] += 1
+        BATCH_SIZE.observe(sum(len(g.waiters) for g in groups), provider=self.provider)
+        for group in groups:
+            group.task = self._loop.create_task(self._run(group))
+
+    async def _run(self, group: _Group) -> None:
+        self._stats["queued"] += 1
+        try:
+            async with self._slots:
+                bucket = _bucket(self.provider)
+                if bucket is not None:
+                    await bucket.acquire()
+                self._stats["calls"] += 1
+                BATCH_REQUESTS.inc(provider=self.provider, result="dispatched")
+                text = await group.call()
+        except asyncio.CancelledError:
+            for w in group.waiters:
+                w.cancel()
+            raise
+        except Exception as e:
+            for w in group.waiters:
+                if not w.done():
+                    w.set_exception(e)
+            return
+        finally:
+            self._stats["queued"] -= 1
+        for w in group.waiters:
+            if not w.done():
+                w.set_result(text)
+
+    def _abandon(self, group: _Group) -> None:
+        # Every caller went away (e.g. lost a hedged race): don't keep the provider call running.
+        if group.task is not None and not group.task.done() and group.abandoned():
+            group.task.cancel()
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, "pending": sum(len(g.waiters) for g in self._groups.values())}
+
+
+def _batcher(provider: str) -> MicroBatcher:
+    key = (id(asyncio.get_running_loop()), provider)
+    b = _batchers.get(key)
+    if b is None:
+        b = _batchers[key] = MicroBatcher(provider)
+    return b
+
+
+async def submit(provider: str, key: Hashable, call: Call) -> str:
+    """
+    Run `call` (one provider request for the prompt identified by `key`) through the provider's
+    microbatch scheduler, or directly when LLM_MICROBATCH is off.
+    """
+    if not enabled():
+        return await call()
+    return await _batcher(provider).submit(key, call)
+
+
+def microbatch_status() -> Dict[str, Any]:
+    out: Dict[str, Any] = {
+        "enabled": enabled(),
+        "windowMs": _window() * 1000.0,
+        "maxBatch": _max_batch(),
+        "concurrency": _concurrency(),
+        "rps": float(os.getenv("LLM_MICROBATCH_RPS", "0")),
+        "providers": {},
+    }
+    for (_loop_id, provider), b in list(_batchers.items()):
+        totals = out["providers"].setdefault(provider, {})
+        for k, v in b.stats().items():
+            totals[k] = totals.get(k, 0) + v
+    return out
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from app.services.circuit_breaker import CircuitOpen
+from app.services.metrics import ROUTER_OUTCOMES
+
+Candidate = Tuple[str, Callable[[], Awaitable[str]]]
+
+# Recent successful call latencies per provider (seconds), for the hedge delay.
+_latencies: Dict[str, Deque[float]] = {}
+_lock = threading.Lock()
+_MIN_SAMPLES = 20
+
+
+def budget_seconds() -> float:
+    """LLM_BUDGET_SECONDS: max time spent waiting on providers per request (0 = no budget)."""
+    return float(os.getenv("LLM_BUDGET_SECONDS", "15"))
+
+
+def hedging_enabled() -> bool:
+    return (os.getenv("LLM_HEDGE") or "1").strip().lower() not in ("0", "false", "no")
+
+
+def record_latency(provider: str, seconds: float) -> None:
+    with _lock:
+        _latencies.setdefault(provider, deque(maxlen=256)).append(seconds)
+
+
+def hedge_delay(provider: str) -> float:
+    """
+    How long to wait on `provider` before also asking the next one: its recent
+    LLM_HEDGE_QUANTILE (p90) latency, or LLM_HEDGE_DEFAULT seconds until enough samples exist.
+    """
+    if not hedging_enabled():
+        return math.inf
+    q = float(os.getenv("LLM_HEDGE_QUANTILE", "0.9"))
+    with _lock:
+        recent = sorted(_latencies.get(provider) or ())
+    if len(recent) < _MIN_SAMPLES:
+        return float(os.getenv("LLM_HEDGE_DEFAULT", "3"))
+    return recent[min(len(recent) - 1, max(0, math.ceil(q * len(recent)) - 1))]
+
+
+def latency_status() -> Dict[str, Dict[str, float]]:
+    with _lock:
+        providers = list(_latencies)
+    return {p: {"hedgeAfter": round(hedge_delay(p), 3), "samples": len(_latencies[p])} for p in providers}
+
+
+async def _timed(provider: str, call: Callable[[], Awaitable[str]]) -> str:
+    t0 = time.perf_counter()
+    text = await call()
+    record_latency(provider, time.perf_counter() - t0)
+    return text
+
+
+async def race(candidates: List[Candidate], budget: float) -> Optional[Tuple[str, str]]:
+    """
+    Run (provider, call) candidates in preference order within `budget` seconds (<= 0: no limit).
+    The next candidate starts as soon as the current one fails, or as a hedge once it has been
+    running longer than its hedge delay. The first success wins and the others are cancelled.
+    Returns (provider, text), or None when every candidate failed or the budget ran out.
+    "exhausted" is only counted when some provider was actually tried (not just refused by its breaker).
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budget if budget > 0 else math.inf
+    queue = list(candidates)
+    running: Dict[asyncio.Task, str] = {}
+    hedge_at = math.inf
+    tried = False
+
+    def launch() -> None:
+        nonlocal hedge_at
+        provider, call = queue.pop(0)
+        running[asyncio.ensure_future(_timed(provider, call))] = provider
+        hedge_at = loop.time() + hedge_delay(provider) if queue else math.inf
+
+    if queue:
+        launch()
+    try:
+        while running:
+            now = loop.time()
+            if now >= deadline:
+                break
+            timeout = min(hedge_at, deadline) - now
+            done, _ = await asyncio.wait(
+                running, timeout=None if math.isinf(timeout) else timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                provider = running.pop(task)
+                if task.cancelled():
+                    continue
+                if task.exception() is None:
+                    ROUTER_OUTCOMES.inc(result="primary" if provider == candidates[0][0] else "hedge")
+                    return provider, task.result()
+                tried = tried or not isinstance(task.exception(), CircuitOpen)
+            # Failover (something failed) or hedge (the current one is slow).
+            if queue and (done or loop.time() >= hedge_at):
+                launch()
+        if tried or running:
+            ROUTER_OUTCOMES.inc(result="exhausted")
+        return None
+    finally:
+        for task in running:
+            task.cancel()
@@ -0,0 +1,333 @@
+"""
+Minimal in-process metrics with Prometheus text exposition (served by GET /api/metrics).
+
+No client library: counters, gauges and histograms keyed by label values. Histograms also keep
+a rolling window of recent observations and export p50/p95/p99 as a companion summary, so the
+percentiles are readable without PromQL. Metrics are per worker process.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Sequence, Tuple
+
+from app.services.circuit_breaker import CircuitOpen
+from app.services.rate_limit import RateLimited
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+_registry: List["_Metric"] = []
+
+
+def _window_size() -> int:
+    return max(1, int(os.getenv("METRICS_WINDOW", "1024")))
+
+
+def _fmt(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr(float(v))
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        with _lock:
+            _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    @abstractmethod
+    def render(self) -> List[str]:
+        """Exposition lines for this metric, without the HELP/TYPE header (called with `_lock` held)."""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_labels(self.label_names, k)} {_fmt(v)}" for k, v in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = float(value)
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_labels(self.label_names, k)} {_fmt(v)}" for k, v in sorted(self._values.items())]
+
+
+class _Series:
+    __slots__ = ("buckets", "sum", "count", "window")
+
+    def __init__(self, n_buckets: int, window: int):
+        self.buckets = [0] * n_buckets
+        self.sum = 0.0
+        self.count = 0
+        self.window: Deque[float] = deque(maxlen=window)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = _LATENCY_BUCKETS,
+        summary: str = "",
+    ):
+        super().__init__(name, help_text, labels)
+        self.bounds = tuple(buckets) + (math.inf,)
+        # Name of the companion summary family (recent-window quantiles); "" = none.
+        self.summary = summary
+        self._series: Dict[Tuple[str, ...], _Series] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with _lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = _Series(len(self.bounds), _window_size())
+            for i, bound in enumerate(self.bounds):
+                if value <= bound:
+                    s.buckets[i] += 1
+                    break
+            s.sum += value
+            s.count += 1
+            s.window.append(value)
+
+    def quantiles(self, **labels: str) -> Dict[str, float]:
+        """p50/p95/p99 over the recent window of one series (empty if no observations)."""
+        with _lock:
+            s = self._series.get(self._key(labels))
+            recent = sorted(s.window) if s is not None else []
+        return _window_quantiles(recent)
+
+    def render(self) -> List[str]:
+        lines: List[str] = []
+        for key, s in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.bounds, s.buckets):
+                cumulative += n
+                le = 'le="%s"' % _fmt(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_fmt(s.sum)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {s.count}")
+        return lines
+
+    def render_summary(self) -> List[str]:
+        lines: List[str] = []
+        for key, s in sorted(self._series.items()):
+            for q, v in _window_quantiles(sorted(s.window)).items():
+                quantile = 'quantile="%s"' % q
+                lines.append(f"{self.summary}{_labels(self.label_names, key, quantile)} {_fmt(v)}")
+            lines.append(f"{self.summary}_sum{_labels(self.label_names, key)} {_fmt(sum(s.window))}")
+            lines.append(f"{self.summary}_count{_labels(self.label_names, key)} {len(s.window)}")
+        return lines
+
+
+def _window_quantiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    # Nearest-rank percentile on the sorted window.
+    return {str(q): values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))] for q in _QUANTILES}
+
+
+def render() -> str:
+    """All registered metrics in Prometheus text format (version 0.0.4)."""
+    out: List[str] = []
+    with _lock:
+        metrics = list(_registry)
+    for m in metrics:
+        with _lock:
+            body = m.render()
+            summary = m.render_summary() if isinstance(m, Histogram) and m.summary else []
+        out.append(f"# HELP {m.name} {m.help}")
+        out.append(f"# TYPE {m.name} {m.kind}")
+        out.extend(body)
+        if isinstance(m, Histogram) and m.summary:
+            out.append(f"# HELP {m.summary} {m.help} (p50/p95/p99 over the last {_window_size()} observations)")
+            out.append(f"# TYPE {m.summary} summary")
+            out.extend(summary)
+    return "\n".join(out) + "\n"
+
+
+# --- chat pipeline metrics ---
+
+STAGE_SECONDS = Histogram(
+    "nlp_stage_duration_seconds",
+    "Time spent in each chat pipeline stage.",
+    ("stage",),
+    summary="nlp_stage_latency_seconds",
+)
+REQUEST_SECONDS = Histogram(
+    "nlp_request_duration_seconds",
+    "End-to-end ChatService answer time by decision path.",
+    ("path",),
+    summary="nlp_request_latency_seconds",
+)
+REQUESTS = Counter("nlp_requests_total", "Chat answers by decision path.", ("path",))
+LLM_SECONDS = Histogram(
+    "nlp_llm_call_duration_seconds",
+    "LLM provider call time by provider, attempt (position in the provider chain) and outcome.",
+    ("provider", "attempt", "outcome"),
+)
+LLM_CALLS = Counter("nlp_llm_calls_total", "LLM provider calls by provider and outcome.", ("provider", "outcome"))
+ROUTER_OUTCOMES = Counter(
+    "nlp_llm_router_total",
+    "Grounded generation races: won by the first provider (primary), a later one (hedge), or none (exhausted).",
+    ("result",),
+)
+
+BATCH_REQUESTS = Counter(
+    "nlp_llm_microbatch_requests_total",
+    "Microbatched LLM requests: sent to the provider (dispatched) or answered by an identical queued prompt.",
+    ("provider", "result"),
+)
+BATCH_SIZE = Histogram(
+    "nlp_llm_microbatch_size",
+    "Callers per flushed microbatch.",
+    ("provider",),
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+
+CONTEXT_TOKENS = Histogram(
+    "nlp_rag_context_tokens",
+    "Estimated tokens in the Sources block of RAG prompts.",
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+CONTEXT_BLOCKS = Counter(
+    "nlp_rag_context_blocks_total",
+    "Retrieved items by how they entered the RAG prompt: kept, trimmed, or dropped (low_score/duplicate/budget).",
+    ("result",),
+)
+
+
+def record_context(packed: Any) -> None:
+    """Metrics for one prompt_builder.PackedContext."""
+    CONTEXT_TOKENS.observe(packed.tokens)
+    CONTEXT_BLOCKS.inc(len(packed.numbers) - packed.trimmed, result="kept")
+    CONTEXT_BLOCKS.inc(packed.trimmed, result="trimmed")
+    for reason, n in packed.dropped.items():
+        CONTEXT_BLOCKS.inc(n, result=reason)
+
+
+GATE_DECISIONS = Counter(
+    "nlp_extractive_gate_total",
+    "Grounded questions answered by the extractive fast path or sent to generation.",
+    ("decision",),
+)
+GATE_SIGNALS = Histogram(
+    "nlp_extractive_gate_signal",
+    "Extractive gate signals (margin, overlap, questionMatch) per grounded question, for tuning the thresholds.",
+    ("signal",),
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+GATE_THRESHOLDS = Gauge(
+    "nlp_extractive_gate_threshold",
+    "Current extractive gate thresholds (EXTRACTIVE_MIN_*).",
+    ("signal",),
+)
+
+
+class StageTimer:
+    """Per-request stage timings (for explain.timings), also fed into the process-wide histograms."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+        self.llm_attempts = 0
+
+    def _add(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            self._add(name, dt)
+            STAGE_SECONDS.observe(dt, stage=name)
+
+    @contextmanager
+    def llm(self, provider: str) -> Iterator[None]:
+        self.llm_attempts += 1
+        attempt = str(self.llm_attempts)
+        t0 = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        except CircuitOpen:
+            # Breaker open: the provider wasn't called.
+            outcome = "short_circuit"
+            raise
+        except RateLimited:
+            # Over the client-side quota: not sent, the caller degrades.
+            outcome = "rate_limited"
+            raise
+        except asyncio.CancelledError:
+            # Lost a hedged race (or the client went away).
+            outcome = "cancelled"
+            raise
+        finally:
+            dt = time.perf_counter() - t0
+            self._add(f"llm:{provider}:{attempt}", dt)
+            STAGE_SECONDS.observe(dt, stage="llm")
+            LLM_SECONDS.observe(dt, provider=provider, attempt=attempt, outcome=outcome)
+            LLM_CALLS.inc(provider=provider, outcome=outcome)
+
+    def finish(self, path: str) -> None:
+        total = time.perf_counter() - self.started
+        self.timings["total"] = total
+        REQUEST_SECONDS.observe(total, path=path)
+        REQUESTS.inc(path=path)
+
+    def as_ms(self) -> Dict[str, float]:
+        return {k: round(v * 1000.0, 3) for k, v in self.timings.items()}
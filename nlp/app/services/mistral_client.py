@@ -1,9 +1,12 @@
 from __future__ import annotations
 
 import os
-from typing import Literal, Optional
+from typing import Any, AsyncIterator, Dict, Tuple
 
-import requests
+from app.services import llm_batch
+from app.services.circuit_breaker import breaker
+from app.services.http_pool import openai_delta_text, provider_async_client, provider_session, sse_data
+from app.services.rate_limit import limiter
 
 
 class MistralClient:
@@ -11,19 +14,20 @@ class MistralClient:
         self.api_key = os.getenv("MISTRAL_API_KEY", "").strip()
         self.model = os.getenv("MISTRAL_MODEL", "mistral-small-latest").strip()
         self.base_url = os.getenv("MISTRAL_BASE_URL", "https://api.mistral.ai").strip().rstrip("/")
+        self._session = provider_session("mistral")
 
     def available(self) -> bool:
         return bool(self.api_key)
 
-    def chat(self, system: str, user: str) -> str:
-        """
-        Uses Mistral Chat Completions API.
-        If no API key is configured, raise and caller should fallback.
-        """
+    def _request(self, system: str, user: str) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
         if not self.api_key:
             raise RuntimeError("MISTRAL_API_KEY not set")
 
         url = f"{self.base_url}/v1/chat/completions"
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
         payload = {
             "model": self.model,
             "messages": [
@@ -32,22 +36,45 @@ class MistralClient:
             ],
             "temperature": 0.2,
         }
-        r = requests.post(
-            url,
-            headers={
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=60,
-        )
-        r.raise_for_status()
-        data = r.json()
-        return data["choices"][0]["message"]["content"]
-
-
+        return url, headers, payload
 
+    def chat(self, system: str, user: str) -> str:
+        """
+        Uses Mistral Chat Completions API.
+        If no API key is configured, raise and caller should fallback.
+        """
+        url, headers, payload = self._request(system, user)
+        with limiter("mistral").hold(f"{system}\n\n{user}"), breaker("mistral").guard():
+            r = self._session.post(url, headers=headers, json=payload, timeout=60)
+            r.raise_for_status()
+            data = r.json()
+            return data["choices"][0]["message"]["content"]
 
+    async def chat_async(self, system: str, user: str) -> str:
+        url, headers, payload = self._request(system, user)
 
+        async def call() -> str:
+            async with limiter("mistral").hold_async(f"{system}\n\n{user}"):
+                with breaker("mistral").guard():
+                    r = await provider_async_client("mistral").post(url, headers=headers, json=payload, timeout=60)
+                    r.raise_for_status()
+                    data = r.json()
+                    return data["choices"][0]["message"]["content"]
 
+        return await llm_batch.submit("mistral", (system, user), call)
 
+    async def chat_stream(self, system: str, user: str) -> AsyncIterator[str]:
+        url, headers, payload = self._request(system, user)
+        payload["stream"] = True
+        async with limiter("mistral").hold_async(f"{system}\n\n{user}"):
+            with breaker("mistral").guard():
+                async with provider_async_client("mistral").stream(
+                    "POST", url, headers=headers, json=payload, timeout=60
+                ) as r:
+                    r.raise_for_status()
+                    async for data in sse_data(r):
+                        if data == "[DONE]":
+                            break
+                        text = openai_delta_text(data)
+                        if text:
+                            yield text
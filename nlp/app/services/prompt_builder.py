@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Sequence, Set, Tuple
+
+from app.services.rate_limit import estimate_tokens
+from app.services.retrieval import RetrievedChunk, _tokenize
+
+# Sentence boundaries: end punctuation (incl. Arabic question mark) followed by space, or a line break.
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?؟])\s+|\n+")
+# Bodies trimmed below this are dropped instead (a few words can't support an answer).
+_MIN_BODY_TOKENS = 16
+
+
+def context_budget() -> int:
+    """RAG_CONTEXT_TOKENS: estimated-token budget for the Sources block of the RAG prompt (0 = no limit)."""
+    return int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))
+
+
+def relative_cutoff() -> float:
+    """RAG_RELATIVE_CUTOFF: drop items scoring below this fraction of the top item's similarity."""
+    return float(os.getenv("RAG_RELATIVE_CUTOFF", "0.5"))
+
+
+def dedup_similarity() -> float:
+    """RAG_DEDUP_SIMILARITY: token Jaccard above which a block repeats a better-ranked one (> 1 = off)."""
+    return float(os.getenv("RAG_DEDUP_SIMILARITY", "0.85"))
+
+
+@dataclass
+class PackedContext:
+    text: str
+    # Source numbers ([n], 1-based positions in the retrieved list) present in the context.
+    numbers: List[int] = field(default_factory=list)
+    tokens: int = 0
+    trimmed: int = 0
+    dropped: Dict[str, int] = field(default_factory=lambda: {"low_score": 0, "duplicate": 0, "budget": 0})
+
+
+@dataclass
+class _Block:
+    number: int
+    header: str
+    body: str
+    tokens: Set[str]
+
+    @property
+    def header_cost(self) -> int:
+        return estimate_tokens(self.header)
+
+    @property
+    def body_cost(self) -> int:
+        return estimate_tokens(self.body)
+
+
+def _jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _water_fill(costs: Sequence[int], budget: int) -> List[int]:
+    """Split `budget` so small blocks keep their full size and large ones share the rest equally."""
+    allowance = [0] * len(costs)
+    remaining = max(0, budget)
+    order = sorted(range(len(costs)), key=lambda i: costs[i])
+    for pos, i in enumerate(order):
+        share = remaining // (len(order) - pos)
+        allowance[i] = min(costs[i], share)
+        remaining -= allowance[i]
+    return allowance
+
+
+def trim_to_relevant(text: str, query: Set[str], max_tokens: int) -> str:
+    """Keep the sentences of `text` that best match the query tokens (in original order) within max_tokens."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    sentences: List[str] = []
+    ranks: List[Tuple[bool, int, int]] = []
+    in_question = False
+    for s in _SENTENCE_SPLIT_RE.split(text):
+        s = s.strip()
+        if not s:
+            continue
+        if re.match(r"(?i)^[QA]:", s):
+            in_question = s[0] in "Qq"
+        # KB entries are "Q: ...\nA: ...": the question restates the user's, the answer is what's needed.
+        ranks.append((in_question, -len(query & set(_tokenize(s))), len(sentences)))
+        sentences.append(s)
+    ranked = [r[2] for r in sorted(ranks)]
+    keep: List[int] = []
+    used = 0
+    for i in ranked:
+        cost = estimate_tokens(sentences[i]) + 1
+        if keep and used + cost > max_tokens:
+            continue
+        keep.append(i)
+        used += cost
+    # The best sentence is kept whole even if it alone exceeds the allowance (no cut emails/phone numbers).
+    return " ".join(sentences[i] for i in sorted(keep))
+
+
+def pack_context(question: str, retrieved: Sequence[RetrievedChunk], budget: int | None = None) -> PackedContext:
+    """
+    Sources block for the RAG prompt: "[n] title / URL / text" per retrieved item, where n stays the
+    item's position in `retrieved` (and in the response's sources) even when other items are left out.
+
+    Items below relative_cutoff() of the top score and near-duplicates of a better-ranked block are
+    dropped; if the blocks exceed the token budget, each body is trimmed to its most query-relevant
+    sentences (small blocks are kept whole), and the lowest-ranked blocks go first if that's not enough.
+    """
+    budget = context_budget() if budget is None else budget
+    cutoff = relative_cutoff()
+    dedup = dedup_similarity()
+    query = set(_tokenize(question))
+    packed = PackedContext(text="")
+
+    blocks: List[_Block] = []
+    top = retrieved[0].similarity if retrieved else 0.0
+    for n, r in enumerate(retrieved, start=1):
+        if blocks and top > 0 and r.similarity < top * cutoff:
+            packed.dropped["low_score"] += 1
+            continue
+        tokens = set(_tokenize(r.item.text))
+        if any(_jaccard(tokens, b.tokens) >= dedup for b in blocks):
+            packed.dropped["duplicate"] += 1
+            continue
+        blocks.append(_Block(n, f"[{n}] {r.item.title}\nURL: {r.item.url}\n", r.item.text, tokens))
+
+    if budget > 0:
+        while True:
+            room = budget - sum(b.header_cost for b in blocks)
+            allowance = _water_fill([b.body_cost for b in blocks], room)
+            starved = any(a < min(b.body_cost, _MIN_BODY_TOKENS) for a, b in zip(allowance, blocks))
+            if not starved or len(blocks) == 1:
+                break
+            blocks.pop()
+            packed.dropped["budget"] += 1
+        for a, b in zip(allowance, blocks):
+            if a < b.body_cost:
+                b.body = trim_to_relevant(b.body, query, max(a, _MIN_BODY_TOKENS))
+                packed.trimmed += 1
+
+    packed.text = "\n\n".join(b.header + b.body for b in blocks)
+    packed.numbers = [b.number for b in blocks]
+    packed.tokens = estimate_tokens(packed.text) if packed.text else 0
+    return packed
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Tuple
+
+from app.services.circuit_breaker import CircuitOpen, breaker
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens/second up to `capacity` (the allowed burst).
+    Reservation style: a caller takes its tokens immediately (the balance may go negative)
+    and waits until the bucket would have covered them, so waiters are served in order.
+    Thread-safe; shared by every event loop / worker thread of the process.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """Take `amount` tokens; returns how many seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount: float) -> None:
+        """Give back tokens reserved for a call that was not made."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        wait = self.reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def available(self) -> float:
+        with self._lock:
+            elapsed = time.monotonic() - self.updated
+            return min(self.capacity, self.tokens + elapsed * self.rate)
+
+
+class RateLimited(RuntimeError):
+    """A provider call would have to wait longer than LLM_RATE_LIMIT_WAIT for its quota (callers degrade)."""
+
+
+# Rough completion size reserved per call in the tokens-per-minute bucket.
+_COMPLETION_TOKENS = 256
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token); good enough for quota pacing and prompt budgets."""
+    return max(1, (len(text) + 3) // 4)
+
+
+def _limit(provider: str, name: str) -> float:
+    # OPENAI_RPM / GEMINI_TPM / MISTRAL_MAX_CONCURRENCY ..., falling back to LLM_RPM / LLM_TPM / LLM_MAX_CONCURRENCY.
+    value = os.getenv(f"{provider.upper()}_{name}") or os.getenv(f"LLM_{name}") or "0"
+    return max(0.0, float(value))
+
+
+class ProviderLimiter:
+    """
+    Client-side quota for one provider, shared by every caller in the process: a requests-per-minute
+    and a tokens-per-minute bucket plus a cap on in-flight calls. A call that can't get its quota
+    within LLM_RATE_LIMIT_WAIT seconds raises RateLimited instead of being sent.
+    Limits are read once, when the provider is first used (0 = unlimited).
+    A provider whose circuit breaker is open is refused before any quota is reserved, and quota
+    taken by a call the breaker then refuses is given back, so breakers still fail fast.
+    """
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.rpm = _limit(provider, "RPM")
+        self.tpm = _limit(provider, "TPM")
+        self.max_concurrency = int(_limit(provider, "MAX_CONCURRENCY"))
+        self.max_wait = float(os.getenv("LLM_RATE_LIMIT_WAIT", "2"))
+        self._requests = TokenBucket(self.rpm / 60.0, self.rpm) if self.rpm > 0 else None
+        self._tokens = TokenBucket(self.tpm / 60.0, self.tpm) if self.tpm > 0 else None
+        self._slots = threading.BoundedSemaphore(self.max_concurrency) if self.max_concurrency > 0 else None
+        self._lock = threading.Lock()
+        self._active = 0
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def _reserve(self, prompt: str) -> Tuple[float, float]:
+        breaker(self.provider).check()
+        cost = float(estimate_tokens(prompt) + _COMPLETION_TOKENS)
+        wait = 0.0
+        if self._requests is not None:
+            wait = max(wait, self._requests.reserve(1.0))
+        if self._tokens is not None:
+            wait = max(wait, self._tokens.reserve(cost))
+        if wait > self.max_wait:
+            self._refund(cost)
+            self._count("rejected")
+            raise RateLimited(f"{self.provider} rate limit: quota available in {wait:.1f}s")
+        return wait, cost
+
+    def _refund(self, cost: float) -> None:
+        if self._requests is not None:
+            self._requests.refund(1.0)
+        if self._tokens is not None:
+            self._tokens.refund(cost)
+
+    def _no_slot(self, cost: float) -> RateLimited:
+        self._refund(cost)
+        self._count("rejected")
+        return RateLimited(f"{self.provider} concurrency limit ({self.max_concurrency} in flight)")
+
+    def _admit(self, waited: bool) -> None:
+        with self._lock:
+            self._active += 1
+            self._stats["admitted"] += 1
+            if waited:
+                self._stats["queued"] += 1
+
+    def _leave(self) -> None:
+        with self._lock:
+            self._active -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    @contextmanager
+    def hold(self, prompt: str) -> Iterator[None]:
+        """Wait (briefly) for quota and a slot, then run the wrapped call."""
+        deadline = time.monotonic() + self.max_wait
+        wait, cost = self._reserve(prompt)
+        if wait > 0:
+            time.sleep(wait)
+        if self._slots is not None and not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise self._no_slot(cost)
+        self._admit(wait > 0)
+        try:
+            yield
+        except CircuitOpen:
+            # The breaker opened while we waited for quota: the call was never sent.
+            self._refund(cost)
+            raise
+        finally:
+            self._leave()
+
+    @asynccontextmanager
+    async def hold_async(self, prompt: str) -> AsyncIterator[None]:
+        deadline = time.monotonic() + self.max_wait
+        wait, cost = self._reserve(prompt)
+        waited = wait > 0
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            # The slot semaphore is shared with threads, so poll it rather than block the loop.
+            while self._slots is not None and not self._slots.acquire(blocking=False):
+                if time.monotonic() >= deadline:
+                    raise self._no_slot(cost)
+                waited = True
+                await asyncio.sleep(0.02)
+        except asyncio.CancelledError:
+            # Lost a hedged race while queued: the call is never made.
+            self._refund(cost)
+            raise
+        self._admit(waited)
+        try:
+            yield
+        except CircuitOpen:
+            self._refund(cost)
+            raise
+        finally:
+            self._leave()
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rpm": self.rpm or None,
+                "tpm": self.tpm or None,
+                "maxConcurrency": self.max_concurrency or None,
+                "inFlight": self._active,
+                "requestsAvailable": round(self._requests.available(), 1) if self._requests else None,
+                "tokensAvailable": round(self._tokens.available()) if self._tokens else None,
+                **self._stats,
+            }
+
+
+_limiters: Dict[str, ProviderLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(provider: str) -> ProviderLimiter:
+    with _limiters_lock:
+        lim = _limiters.get(provider)
+        if lim is None:
+            lim = _limiters[provider] = ProviderLimiter(provider)
+        return lim
+
+
+def rate_limit_status() -> Dict[str, Any]:
+    with _limiters_lock:
+        items = sorted(_limiters.items())
+    return {
+        "maxWaitSeconds": float(os.getenv("LLM_RATE_LIMIT_WAIT", "2")),
+        "providers": {p: lim.status() for p, lim in items},
+    }
@@ -1,12 +1,21 @@
 from __future__ import annotations
 
+import hashlib
+import heapq
+import json
 import math
+import mmap
 import os
 import re
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left, insort
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
-from app.services.knowledge_base import KBItem
+from app.services.knowledge_base import KBItem, parse_kb_records, read_kb_record
 
 
 @dataclass
@@ -103,76 +112,959 @@ def _is_arabic_text(text: str) -> bool:
     return bool(_ARABIC_RE.search(text or ""))
 
 
+def _doc_lang(text: str) -> str:
+    return "ar" if _is_arabic_text(text) else "en"
+
+
+def _tf_weights(toks: List[str]) -> Dict[str, float]:
+    # Sublinear TF weight 1+log(tf) per distinct token.
+    tf: Dict[str, int] = {}
+    for t in toks:
+        tf[t] = tf.get(t, 0) + 1
+    return {t: 1.0 + math.log(c) for t, c in tf.items()}
+
+
+# Pruning bars are lowered by this factor to absorb float rounding (see Retriever._search).
+_PRUNE_SLACK = 1.0 - 1e-9
+
+
+def min_token_overlap() -> int:
+    return int(os.getenv("MIN_TOKEN_OVERLAP", "2"))
+
+
+def build_retriever(items: List[KBItem]):
+    """
+    Pick the retrieval engine from RETRIEVER_ENGINE:
+      - "python" (default): pure-Python inverted index below
+      - "sparse": numpy/scipy vectorized engine (app.services.sparse_retrieval)
+    Falls back to the pure-Python engine when numpy/scipy are not installed.
+    """
+    engine = (os.getenv("RETRIEVER_ENGINE") or "python").strip().lower()
+    cls: Any = Retriever
+    if engine == "sparse":
+        try:
+            from app.services.sparse_retrieval import SparseRetriever
+
+            cls = SparseRetriever
+        except ImportError:
+            pass
+    if question_weight() > 0 and any(it.question for it in items):
+        return QuestionFusionRetriever(items, cls)
+    return cls(items)
+
+
+def question_weight() -> float:
+    """RETRIEVAL_QUESTION_WEIGHT: share of the question-index score in fused similarities (0 = full text only)."""
+    return float(os.getenv("RETRIEVAL_QUESTION_WEIGHT", "0"))
+
+
+def _question_item(it: KBItem) -> KBItem:
+    # Question-only pseudo doc (same id/title/url) for an entry with a parsed "Q:" line.
+    # Built without KBItem.__init__: the "Q:" line is already parsed, no need to run split_qa again.
+    q = KBItem.__new__(KBItem)
+    q.id, q.title, q.url, q.type, q.text = it.id, it.title, it.url, it.type, it.question
+    q.question, q.answer = "", it.question
+    return q
+
+
+class QuestionFusionRetriever:
+    """
+    Full-text index plus a second, much smaller index over the parsed "Q:" lines only.
+    Long answers dilute full-text scores; matching the question part directly ranks FAQ
+    entries by what they are about. For entries with a question the fused similarity is
+    (1 - w) * full_text + w * question (w = RETRIEVAL_QUESTION_WEIGHT); others keep their
+    full-text score. Both indexes use the same engine; `updated()` returns a new instance.
+    """
+
+    def __init__(self, items: List[KBItem], cls: Any = None):
+        self._cls = cls or Retriever
+        pairs = self._pair_questions(items, {})
+        self._set(items, self._cls(items), self._cls(self._question_docs(items, pairs)), pairs)
+
+    @staticmethod
+    def _pair_questions(
+        items: Sequence[KBItem], known: Dict[int, Tuple[KBItem, KBItem]]
+    ) -> Dict[int, Tuple[KBItem, KBItem]]:
+        # id(item) -> (item, its question pseudo doc); items a reload carried over keep theirs.
+        pairs: Dict[int, Tuple[KBItem, KBItem]] = {}
+        for it in items:
+            if it.question:
+                pair = known.get(id(it))
+                pairs[id(it)] = pair if pair is not None and pair[0] is it else (it, _question_item(it))
+        return pairs
+
+    @staticmethod
+    def _question_docs(items: Sequence[KBItem], pairs: Dict[int, Tuple[KBItem, KBItem]]) -> List[KBItem]:
+        return [pairs[id(it)][1] for it in items if it.question]
+
+    def _set(
+        self, items: Sequence[KBItem], full: Any, questions: Any, pairs: Dict[int, Tuple[KBItem, KBItem]]
+    ) -> None:
+        self._full = full
+        self._questions = questions
+        self._pairs = pairs
+        self._size = len(items)
+        # KB position of each id: ties are ranked in KB order, like the engines do.
+        self._order: Dict[str, int] = {}
+        for pos, it in enumerate(items):
+            self._order.setdefault(it.id, pos)
+        self._all_questions = all(it.question for it in items)
+
+    @property
+    def engine(self) -> str:
+        return self._full.engine
+
+    @property
+    def from_index(self) -> bool:
+        return False
+
+    @property
+    def items(self) -> Sequence[KBItem]:
+        return self._full.items
+
+    def updated(
+        self, items: List[KBItem], changes: Optional[Tuple[Sequence[KBItem], Sequence[KBItem]]] = None
+    ) -> Tuple["QuestionFusionRetriever", Dict[str, int]]:
+        """Index a reloaded KB into a new instance (incrementally when the engine supports it)."""
+        new = QuestionFusionRetriever.__new__(QuestionFusionRetriever)
+        new._cls = self._cls
+        pairs = self._pair_questions(items, self._pairs)
+        q_docs = self._question_docs(items, pairs)
+        if hasattr(self._full, "updated"):
+            full, stats = self._full.updated(items, changes)
+            q_changes = None
+            if changes is not None and all(id(it) in self._pairs for it in changes[0] if it.question):
+                removed, added = changes
+                q_changes = (
+                    [self._pairs[id(it)][1] for it in removed if it.question],
+                    [pairs[id(it)][1] for it in added if it.question],
+                )
+            questions, _ = self._questions.updated(q_docs, q_changes)
+        else:
+            full, questions = self._cls(items), self._cls(q_docs)
+            stats = {"rebuilt": len(items)}
+        new._set(items, full, questions, pairs)
+        return new, stats
+
+    def search(self, query: str, top_k: int = 4, lang: str | None = None) -> List[RetrievedChunk]:
+        """
+        Exact top-k by fused similarity (threshold algorithm over the two rankings):
+          1. the best n question hits (n = top_k at first) are scored exactly in the full-text
+             index; their k-th best fused score is a bar the full-text pass must help clear,
+             which lets it prune (search `floor`);
+          2. the full-text hits are scored exactly in the question index;
+          3. an item in neither list scores at most (1 - w) * last full-text + w * last question
+             score; if the k-th fused score is below that, n doubles and we go again.
+        """
+        if top_k <= 0 or not self._size:
+            return []
+        w = min(max(question_weight(), 0.0), 1.0)
+        n = top_k
+        while True:
+            questions = self._questions.search(query, top_k=n, lang=lang)
+            q_sim = {r.item.id: r.similarity for r in questions}
+            q_cut = questions[-1].similarity if len(questions) >= n else 0.0
+            full = self._full.score_items(query, q_sim, lang)
+            seeds = sorted((self._fused(c, q_sim, w) for c in full.values()), reverse=True)
+            floor = 0.0
+            if len(seeds) >= top_k and w < 1.0:
+                bar = seeds[top_k - 1]
+                floor = (bar - w * q_cut) / (1.0 - w)
+                if not self._all_questions:
+                    floor = min(floor, bar)
+            hits = self._full.search(query, top_k=n, lang=lang, floor=max(floor, 0.0))
+            f_cut = hits[-1].similarity if len(hits) >= n else max(floor, 0.0)
+            missing = [r.item.id for r in hits if r.item.id not in full and r.item.question]
+            # Below a short question list, items score 0 on the question side.
+            if missing and len(questions) >= n:
+                q_sim.update((i, c.similarity) for i, c in self._questions.score_items(query, missing, lang).items())
+            for r in hits:
+                full.setdefault(r.item.id, r)
+
+            ranked = sorted(full.values(), key=lambda c: (-self._fused(c, q_sim, w), self._order.get(c.item.id, 0)))
+            fused = [RetrievedChunk(item=c.item, similarity=self._fused(c, q_sim, w)) for c in ranked[:top_k]]
+            unseen = max((1.0 - w) * f_cut + w * q_cut, 0.0 if self._all_questions else f_cut)
+            if unseen <= 0.0 or n >= self._size or (len(fused) >= top_k and fused[-1].similarity >= unseen):
+                return fused
+            n *= 2
+
+    def search_batch(
+        self, queries: List[str], top_k: int = 4, lang: str | None = None
+    ) -> List[List[RetrievedChunk]]:
+        return [self.search(q, top_k, lang) for q in queries]
+
+    @staticmethod
+    def _fused(chunk: RetrievedChunk, q_sim: Dict[str, float], w: float) -> float:
+        if not chunk.item.question:
+            return chunk.similarity
+        return (1.0 - w) * chunk.similarity + w * q_sim.get(chunk.item.id, 0.0)
+
+
+# On-disk index (see tools/build_index.py). Layout:
+#   header: magic, version, reserved, meta offset, meta length
+#   8-byte aligned binary sections (norms, lang flags, the docs' jsonl lines, partition doc
+#   lists, concatenated postings ids/weights, the vocabulary sorted by UTF-8 bytes with each
+#   partition's postings start/count/max impact per token, item id keys), then a small JSON meta
+#   block with the section table and the KB file size/mtime the index was built from.
+# Strings are stored as one UTF-8 blob plus an (n + 1)-entry offsets table.
+_INDEX_MAGIC = b"NLPKBIDX"
+_INDEX_VERSION = 3
+_INDEX_HEADER = struct.Struct("<8sIIQQ")
+
+
+class _MappedStrings(Sequence):
+    """Strings of an on-disk index, decoded from the mapping on access."""
+
+    def __init__(self, offsets: Sequence[int], blob: memoryview):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def key(self, i: int) -> bytes:
+        return bytes(self._blob[self._offsets[i] : self._offsets[i + 1]])
+
+    def __getitem__(self, i):  # type: ignore[override]
+        return self.key(i).decode("utf-8")
+
+
+class _MappedVocab:
+    """Sorted token table of an on-disk index: a token is found by binary search over the mapping."""
+
+    # Recently looked-up tokens (a query asks for the same token's df, impact and postings).
+    _CACHE_SIZE = 4096
+
+    def __init__(self, tokens: _MappedStrings):
+        self._tokens = tokens
+        self._cache: Dict[str, int] = {}
+
+    def find(self, tok: str) -> int:
+        i = self._cache.get(tok)
+        if i is None:
+            if len(self._cache) >= self._CACHE_SIZE:
+                self._cache.clear()
+            i = self._cache[tok] = self._search(tok)
+        return i
+
+    def _search(self, tok: str) -> int:
+        key = tok.encode("utf-8")
+        lo, hi = 0, len(self._tokens)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._tokens.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self._tokens) and self._tokens.key(lo) == key else -1
+
+
+class _VocabView:
+    """Read-only {token: value} view over a mapped vocab (`value(i)` is None for absent entries)."""
+
+    def __init__(self, vocab: _MappedVocab, value: Callable[[int], Any]):
+        self._vocab = vocab
+        self._value = value
+
+    def get(self, tok: str, default: Any = None) -> Any:
+        i = self._vocab.find(tok)
+        if i < 0:
+            return default
+        value = self._value(i)
+        return default if value is None else value
+
+    def __contains__(self, tok: object) -> bool:
+        return isinstance(tok, str) and self.get(tok) is not None
+
+
+class _MappedPartition:
+    """One language partition's per-token tables of an on-disk index (count 0 = token absent)."""
+
+    def __init__(
+        self, starts: Sequence[int], counts: Sequence[int], impacts: Sequence[float], ids: memoryview, weights: memoryview
+    ):
+        self.counts = counts
+        self._starts = starts
+        self._impacts = impacts
+        self._ids = ids
+        self._weights = weights
+
+    def postings(self, i: int) -> Tuple[memoryview, memoryview] | None:
+        count = self.counts[i]
+        if not count:
+            return None
+        start = self._starts[i]
+        return self._ids[start : start + count], self._weights[start : start + count]
+
+    def impact(self, i: int) -> float | None:
+        return self._impacts[i] if self.counts[i] else None
+
+
+class _MappedDocs(Sequence):
+    """
+    Read-only KB items of an on-disk index: only the lines we return are parsed. The jsonl lines
+    are copied into the index when it is built, so edits to the KB file never reach a mapped index
+    (the reload that follows them publishes a new one).
+    """
+
+    def __init__(self, lines: _MappedStrings):
+        self._lines = lines
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def __getitem__(self, i):  # type: ignore[override]
+        raw = self._lines.key(i)
+        return read_kb_record(raw, 0, len(raw))
+
+
+class _LangFlags(Sequence):
+    def __init__(self, flags: Sequence[int]):
+        self._flags = flags
+
+    def __len__(self) -> int:
+        return len(self._flags)
+
+    def __getitem__(self, i):  # type: ignore[override]
+        return "ar" if self._flags[i] else "en"
+
+
+def _string_table(strings: Iterable[bytes]) -> Tuple[array, array]:
+    offsets = array("q", [0])
+    blob = bytearray()
+    for raw in strings:
+        blob += raw
+        offsets.append(len(blob))
+    return offsets, array("B", blob)
+
+
+def open_index(index_path: str | None, kb_path: str | None) -> Optional["Retriever"]:
+    """
+    Open a prebuilt index if it exists and still matches the KB file (size + mtime);
+    otherwise return None so the caller builds an in-memory index instead.
+    """
+    if not index_path or not kb_path or not os.path.exists(index_path):
+        return None
+    try:
+        return Retriever.open_index(index_path, kb_path)
+    except (OSError, ValueError):
+        return None
+
+
+def build_index_file(kb_path: str, out_path: str) -> int:
+    """Index `kb_path` and write it to `out_path` for open_index. Returns the doc count."""
+    with open(kb_path, "rb") as f:
+        st = os.fstat(f.fileno())
+        data = f.read()
+    records = list(parse_kb_records(data))
+    retriever = Retriever([it for _, _, it in records])
+    retriever.save_index(out_path, kb_path, [data[offset : offset + length] for offset, length, _ in records], st)
+    return len(records)
+
+
+def shared_index_path(kb_path: str) -> str:
+    # One file per KB, on tmpfs when available so workers share it straight from RAM.
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    key = hashlib.sha1(os.path.abspath(kb_path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(base, f"nlp-kb-{key}.idx")
+
+
+def open_shared_index(kb_path: str | None) -> Optional["Retriever"]:
+    """
+    Multi-worker mode: attach to the shared index for this KB, building it first if it is
+    missing or stale. The first worker (or a parent calling this before forking) pays
+    the build; every other worker just maps the same file read-only.
+    """
+    if not kb_path:
+        return None
+    path = shared_index_path(kb_path)
+    retriever = open_index(path, kb_path)
+    if retriever is None:
+        try:
+            build_index_file(kb_path, path)
+        except OSError:
+            return None
+        retriever = open_index(path, kb_path)
+    return retriever
+
+
 class Retriever:
     """
     Ultra-light retriever (no numpy / no sklearn) using a TF-IDF-like scoring.
     Not as strong as LaBSE, but works reliably on Windows with low disk space.
     """
 
+    engine = "python"
+
     def __init__(self, items: List[KBItem]):
-        self.items = items
-        self._docs_tokens: List[List[str]] = [_tokenize(it.text) for it in items]
-        self._idf: Dict[str, float] = self._build_idf(self._docs_tokens)
+        # A published index is never modified: `updated()` applies a reload to a copy.
+        self._reset(items)
+
+    def _reset(self, items: List[KBItem]) -> None:
+        # Doc ids are slots in `_docs`; incremental updates leave None tombstones for deleted docs.
+        self._docs: Sequence[Optional[KBItem]] = list(items)
+        self._doc_ids: List[Optional[str]] = [it.id for it in items]
+        self._n_live = len(items)
+        # Set when the index is served from a read-only on-disk file (see open_index).
+        self._readonly = False
+        # (part, token) postings this index may edit in place; None = all of them (see _copy).
+        self._owned: Optional[Set[Tuple[str, str]]] = None
+        # item.id -> live doc ids, to diff a reloaded KB against this index (tuples: copies share them).
+        self._id_docs: Dict[str, Tuple[int, ...]] = {}
+        for doc_id, it in enumerate(items):
+            self._id_docs[it.id] = self._id_docs.get(it.id, ()) + (doc_id,)
+        # Language of each doc ("ar" | "en"), computed once at load time.
+        self._doc_lang: List[str] = [_doc_lang(it.text) for it in items]
+        # Inverted index, pre-partitioned by language:
+        #   lang -> token -> (doc ids, 1+log(tf) weights) as parallel arrays in doc order.
+        # Doc ids are global; per-document length norms sqrt(len+1) live in one array.
+        self._postings: Dict[str, Dict[str, Tuple[array, array]]] = {}
+        self._lang_docs: Dict[str, array] = {}
+        self._doc_norms: array = array("d")
+        # lang -> token -> max(weight / norm) over its postings (max-score upper bounds).
+        self._max_impact: Dict[str, Dict[str, float]] = {}
+        self._build_index([_tokenize(it.text) for it in items])
+        # Document frequency across partitions; IDF is derived from it and the live doc count.
+        self._df: Dict[str, int] = self._build_df()
+
+    @property
+    def from_index(self) -> bool:
+        return self._readonly
 
-    def _build_idf(self, docs_tokens: List[List[str]]) -> Dict[str, float]:
+    @property
+    def items(self) -> Sequence[KBItem]:
+        if self._readonly:
+            return self._docs  # type: ignore[return-value]
+        return [it for it in self._docs if it is not None]
+
+    def _build_index(self, docs_tokens: List[List[str]]) -> None:
+        postings: Dict[str, Dict[str, Tuple[List[int], List[float]]]] = {"ar": {}, "en": {}}
+        lang_docs: Dict[str, List[int]] = {"ar": [], "en": []}
+        max_impact: Dict[str, Dict[str, float]] = {"ar": {}, "en": {}}
+        for doc_id, toks in enumerate(docs_tokens):
+            part = self._doc_lang[doc_id]
+            lang_docs[part].append(doc_id)
+            norm = math.sqrt(len(toks) + 1)
+            for t, w in _tf_weights(toks).items():
+                ids, weights = postings[part].setdefault(t, ([], []))
+                ids.append(doc_id)
+                weights.append(w)
+                if w / norm > max_impact[part].get(t, 0.0):
+                    max_impact[part][t] = w / norm
+            self._doc_norms.append(norm)
+        self._postings = {
+            part: {t: (array("i", ids), array("d", w)) for t, (ids, w) in plists.items()}
+            for part, plists in postings.items()
+        }
+        self._lang_docs = {part: array("i", ids) for part, ids in lang_docs.items()}
+        self._max_impact = max_impact
+
+    def _build_df(self) -> Dict[str, int]:
+        # Document frequency is the total postings length across partitions.
         df: Dict[str, int] = {}
-        n = len(docs_tokens) or 1
-        for toks in docs_tokens:
-            for tok in set(toks):
-                df[tok] = df.get(tok, 0) + 1
-        idf: Dict[str, float] = {}
-        for tok, d in df.items():
-            idf[tok] = math.log((n + 1) / (d + 1)) + 1.0
-        return idf
-
-    def _score(self, q_tokens: List[str], doc_tokens: List[str]) -> float:
-        if not q_tokens or not doc_tokens:
-            return 0.0
-        doc_tf: Dict[str, int] = {}
-        for t in doc_tokens:
-            doc_tf[t] = doc_tf.get(t, 0) + 1
-
-        score = 0.0
-        for t in q_tokens:
-            if t in doc_tf:
-                score += (1.0 + math.log(doc_tf[t])) * self._idf.get(t, 1.0)
+        for plists in self._postings.values():
+            for tok, (ids, _) in plists.items():
+                df[tok] = df.get(tok, 0) + len(ids)
+        return df
 
-        # Normalize by doc length a bit to avoid bias towards long docs
-        return score / math.sqrt(len(doc_tokens) + 1)
+    def _idf(self, tok: str) -> float | None:
+        d = self._df.get(tok)
+        if d is None:
+            return None
+        n = self._n_live or 1
+        return math.log((n + 1) / (d + 1)) + 1.0
 
-    def search(self, query: str, top_k: int = 4, lang: str | None = None) -> List[RetrievedChunk]:
-        if not self.items:
+    # --- incremental updates ---
+    def updated(
+        self, items: List[KBItem], changes: Optional[Tuple[Sequence[KBItem], Sequence[KBItem]]] = None
+    ) -> Tuple["Retriever", Dict[str, int]]:
+        """
+        Index a reloaded KB by diffing it against this one, without touching this index
+        (searches keep running on it until the caller publishes the returned one).
+        Items are matched by id (in file order for repeated ids) and compared by content:
+        changed items are re-indexed in their existing slot, new ones are appended, and
+        missing ones are removed. Only those docs are re-tokenized; DF/IDF follow.
+        `changes` = (removed, added) item objects (knowledge_base.kb_changes) skips the diff:
+        only those items are looked at.
+        """
+        if self._readonly:
+            # The on-disk index can't be diffed in place: switch to an in-memory index.
+            return build_retriever(items), {"rebuilt": len(items)}
+        new = self._copy()
+        slots = new._slots(changes[0]) if changes is not None else None
+        if slots is None:
+            return new, new._update(items)
+        return new, new._apply(slots, changes[1])  # type: ignore[index]
+
+    def _copy(self) -> "Retriever":
+        # Per-doc tables are copied; postings arrays are shared until the copy first edits them.
+        new = Retriever.__new__(Retriever)
+        new._docs = list(self._docs)
+        new._doc_ids = list(self._doc_ids)
+        new._n_live = self._n_live
+        new._readonly = False
+        new._owned = set()
+        new._id_docs = dict(self._id_docs)
+        new._doc_lang = list(self._doc_lang)
+        new._postings = {part: dict(plists) for part, plists in self._postings.items()}
+        new._lang_docs = {part: array("i", ids) for part, ids in self._lang_docs.items()}
+        new._doc_norms = array("d", self._doc_norms)
+        new._max_impact = {part: dict(impacts) for part, impacts in self._max_impact.items()}
+        new._df = dict(self._df)
+        return new
+
+    def _own_postings(self, part: str, tok: str) -> Tuple[array, array] | None:
+        plist = self._postings[part].get(tok)
+        if plist is None or self._owned is None or (part, tok) in self._owned:
+            return plist
+        plist = self._postings[part][tok] = (array("i", plist[0]), array("d", plist[1]))
+        self._owned.add((part, tok))
+        return plist
+
+    def _update(self, items: List[KBItem]) -> Dict[str, int]:
+        stats = {"added": 0, "updated": 0, "deleted": 0}
+        new_by_id: Dict[str, List[KBItem]] = {}
+        for it in items:
+            new_by_id.setdefault(it.id, []).append(it)
+
+        for item_id, doc_ids in list(self._id_docs.items()):
+            new_items = new_by_id.get(item_id, [])
+            for doc_id in doc_ids[len(new_items) :]:
+                self._drop_doc(doc_id)
+                stats["deleted"] += 1
+            for doc_id, new_it in zip(doc_ids, new_items):
+                old_it = self._docs[doc_id]
+                if old_it is not new_it and old_it != new_it:
+                    self._replace_doc(doc_id, new_it)
+                    stats["updated"] += 1
+            if not new_items:
+                del self._id_docs[item_id]
+            elif len(new_items) < len(doc_ids):
+                self._id_docs[item_id] = doc_ids[: len(new_items)]
+
+        for item_id, new_items in new_by_id.items():
+            doc_ids = self._id_docs.get(item_id, ())
+            extra = new_items[len(doc_ids) :]
+            if extra:
+                self._id_docs[item_id] = doc_ids + tuple(self._append_doc(new_it) for new_it in extra)
+                stats["added"] += len(extra)
+        self._compact()
+        return stats
+
+    def _slots(self, removed: Sequence[KBItem]) -> Optional[Dict[str, List[int]]]:
+        # Doc ids of the removed items, by item id (None if one isn't in this index).
+        slots: Dict[str, List[int]] = {}
+        for it in removed:
+            doc_id = next((d for d in self._id_docs.get(it.id, ()) if self._docs[d] is it), None)
+            if doc_id is None:
+                return None
+            slots.setdefault(it.id, []).append(doc_id)
+        return slots
+
+    def _apply(self, slots: Dict[str, List[int]], added: Sequence[KBItem]) -> Dict[str, int]:
+        # An added item takes over the slot of a removed one with the same id (an edit).
+        stats = {"added": 0, "updated": 0, "deleted": 0}
+        for it in added:
+            freed = slots.get(it.id)
+            if freed:
+                self._replace_doc(freed.pop(0), it)
+                stats["updated"] += 1
+            else:
+                self._id_docs[it.id] = self._id_docs.get(it.id, ()) + (self._append_doc(it),)
+                stats["added"] += 1
+        for item_id, freed in slots.items():
+            for doc_id in freed:
+                self._drop_doc(doc_id)
+                stats["deleted"] += 1
+            left = tuple(d for d in self._id_docs[item_id] if d not in freed)
+            if left:
+                self._id_docs[item_id] = left
+            else:
+                del self._id_docs[item_id]
+        self._compact()
+        return stats
+
+    def _drop_doc(self, doc_id: int) -> None:
+        self._unindex_doc(doc_id)
+        self._docs[doc_id] = None
+        self._doc_ids[doc_id] = None
+        self._n_live -= 1
+
+    def _replace_doc(self, doc_id: int, it: KBItem) -> None:
+        self._unindex_doc(doc_id)
+        self._docs[doc_id] = it
+        self._index_doc(doc_id)
+
+    def _append_doc(self, it: KBItem) -> int:
+        doc_id = len(self._docs)
+        self._docs.append(it)
+        self._doc_ids.append(it.id)
+        self._doc_lang.append("en")
+        self._doc_norms.append(1.0)
+        self._n_live += 1
+        self._index_doc(doc_id)
+        return doc_id
+
+    def _compact(self) -> None:
+        # Too many tombstones: compact doc ids with a full rebuild.
+        if len(self._docs) > 2 * max(self._n_live, 1):
+            self._reset(self.items)
+
+    def _index_doc(self, doc_id: int) -> None:
+        it = self._docs[doc_id]
+        assert it is not None
+        toks = _tokenize(it.text)
+        part = _doc_lang(it.text)
+        self._doc_lang[doc_id] = part
+        norm = math.sqrt(len(toks) + 1)
+        self._doc_norms[doc_id] = norm
+        insort(self._lang_docs[part], doc_id)
+        for t, w in _tf_weights(toks).items():
+            plist = self._own_postings(part, t)
+            if plist is None:
+                plist = self._postings[part][t] = (array("i"), array("d"))
+                if self._owned is not None:
+                    self._owned.add((part, t))
+            ids, weights = plist
+            j = bisect_left(ids, doc_id)
+            ids.insert(j, doc_id)
+            weights.insert(j, w)
+            self._df[t] = self._df.get(t, 0) + 1
+            if w / norm > self._max_impact[part].get(t, 0.0):
+                self._max_impact[part][t] = w / norm
+
+    def _unindex_doc(self, doc_id: int) -> None:
+        it = self._docs[doc_id]
+        assert it is not None
+        part = self._doc_lang[doc_id]
+        norm = self._doc_norms[doc_id]
+        lang_docs = self._lang_docs[part]
+        del lang_docs[bisect_left(lang_docs, doc_id)]
+        for t, w in _tf_weights(_tokenize(it.text)).items():
+            ids, weights = self._own_postings(part, t)  # type: ignore[misc]
+            j = bisect_left(ids, doc_id)
+            del ids[j]
+            del weights[j]
+            self._df[t] -= 1
+            if not self._df[t]:
+                del self._df[t]
+            if not ids:
+                del self._postings[part][t]
+                del self._max_impact[part][t]
+            elif w / norm >= self._max_impact[part][t]:
+                self._max_impact[part][t] = max(wj / self._doc_norms[d] for d, wj in zip(ids, weights))
+
+    # --- on-disk index ---
+    def save_index(
+        self, path: str, kb_path: str, lines: Sequence[bytes], kb_stat: os.stat_result | None = None
+    ) -> None:
+        """
+        Write this index to `path` (atomically). `lines` are each doc's jsonl line (the index keeps
+        its own copy); `kb_stat` is the stat of `kb_path` they were read under (default: stat it now).
+        """
+        if self._readonly or len(self._docs) != self._n_live or len(lines) != self._n_live:
+            raise ValueError("save_index needs a freshly built in-memory index")
+        vocab = sorted(self._df, key=lambda t: t.encode("utf-8"))
+        vocab_offsets, vocab_bytes = _string_table(t.encode("utf-8") for t in vocab)
+        doc_offsets, doc_bytes = _string_table(lines)
+        # Hits are de-duplicated by item id: a dense number per distinct id is all the index needs.
+        id_numbers: Dict[Optional[str], int] = {}
+        id_keys = array("i", [id_numbers.setdefault(item_id, len(id_numbers)) for item_id in self._doc_ids])
+        post_ids = array("i")
+        post_weights = array("d")
+        # Per partition and vocab entry: where its postings start, how many (0 = absent), max impact.
+        vocab_tables: Dict[str, array] = {}
+        for part in ("ar", "en"):
+            starts, counts, impacts = array("q"), array("i"), array("d")
+            for tok in vocab:
+                ids, weights = self._postings[part].get(tok, ((), ()))
+                starts.append(len(post_ids))
+                counts.append(len(ids))
+                impacts.append(self._max_impact[part].get(tok, 0.0))
+                post_ids.extend(ids)
+                post_weights.extend(weights)
+            vocab_tables.update({f"{part}_starts": starts, f"{part}_counts": counts, f"{part}_impacts": impacts})
+        sections = {
+            "norms": self._doc_norms,
+            "lang": array("B", [1 if lang == "ar" else 0 for lang in self._doc_lang]),
+            "doc_offsets": doc_offsets,
+            "doc_bytes": doc_bytes,
+            "ar_docs": self._lang_docs["ar"],
+            "en_docs": self._lang_docs["en"],
+            "post_ids": post_ids,
+            "post_weights": post_weights,
+            "vocab_offsets": vocab_offsets,
+            "vocab_bytes": vocab_bytes,
+            "id_keys": id_keys,
+            **vocab_tables,
+        }
+        st = kb_stat or os.stat(kb_path)
+        meta: Dict[str, Any] = {
+            "byteorder": sys.byteorder,
+            "kb": {"name": os.path.basename(kb_path), "size": st.st_size, "mtime": st.st_mtime},
+            "sections": {},
+        }
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"\0" * _INDEX_HEADER.size)
+            for name, arr in sections.items():
+                meta["sections"][name] = [f.tell(), len(arr), arr.typecode]
+                arr.tofile(f)
+                f.write(b"\0" * (-f.tell() % 8))
+            meta_offset = f.tell()
+            blob = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+            f.write(blob)
+            f.seek(0)
+            f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, 0, meta_offset, len(blob)))
+        os.replace(tmp, path)
+
+    @classmethod
+    def open_index(cls, path: str, kb_path: str) -> "Retriever":
+        """
+        Serve an index written by save_index straight from an mmap of the file: postings,
+        norms and doc lists are zero-copy views, so every worker shares the page cache.
+        KB items are parsed lazily from the index's copy of the jsonl, for the hits we return.
+        """
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls._from_buffer(mm, kb_path)
+
+    @classmethod
+    def _from_buffer(cls, buf: Any, kb_path: str) -> "Retriever":
+        view = memoryview(buf)
+        magic, version, _, meta_offset, meta_len = _INDEX_HEADER.unpack_from(view, 0)
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+            raise ValueError("Not a KB index (or unsupported version); rebuild it with tools/build_index.py")
+        meta = json.loads(bytes(view[meta_offset : meta_offset + meta_len]).decode("utf-8"))
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError("KB index was built on a machine with a different byte order")
+        st = os.stat(kb_path)
+        kb = meta["kb"]
+        if kb["name"] != os.path.basename(kb_path) or kb["size"] != st.st_size or kb["mtime"] != st.st_mtime:
+            raise ValueError("KB index is stale (KB file changed since it was built)")
+
+        def section(name: str) -> memoryview:
+            offset, count, typecode = meta["sections"][name]
+            size = array(typecode).itemsize
+            return view[offset : offset + count * size].cast(typecode)
+
+        self = cls.__new__(cls)
+        self._buffer = buf  # keeps the mapping alive for the views below
+        self._readonly = True
+        self._owned = None
+        # Nothing below is materialized per token or per doc: tables are views of the mapping,
+        # tokens are found by binary search and postings are sliced when a query uses them.
+        self._doc_ids = section("id_keys")  # type: ignore[assignment]
+        self._n_live = len(self._doc_ids)
+        self._docs = _MappedDocs(_MappedStrings(section("doc_offsets"), section("doc_bytes")))
+        self._id_docs = {}
+        self._doc_lang = _LangFlags(section("lang"))
+        self._doc_norms = section("norms")
+        self._lang_docs = {"ar": section("ar_docs"), "en": section("en_docs")}
+        vocab = _MappedVocab(_MappedStrings(section("vocab_offsets"), section("vocab_bytes")))
+        post_ids = section("post_ids")
+        post_weights = section("post_weights")
+        self._postings = {}
+        self._max_impact = {}
+        tables = {
+            part: _MappedPartition(
+                section(f"{part}_starts"), section(f"{part}_counts"), section(f"{part}_impacts"), post_ids, post_weights
+            )
+            for part in ("ar", "en")
+        }
+        for part, table in tables.items():
+            self._postings[part] = _VocabView(vocab, table.postings)  # type: ignore[assignment]
+            self._max_impact[part] = _VocabView(vocab, table.impact)  # type: ignore[assignment]
+        self._df = _VocabView(vocab, lambda i: tables["ar"].counts[i] + tables["en"].counts[i])  # type: ignore[assignment]
+        return self
+
+    def _partitions(self, lang: str | None) -> List[str]:
+        # Optional language filter to avoid mixing AR/EN when not needed.
+        if lang in ("ar", "en"):
+            return [lang]
+        return ["ar", "en"]
+
+    def search(
+        self, query: str, top_k: int = 4, lang: str | None = None, floor: float = 0.0
+    ) -> List[RetrievedChunk]:
+        """Best `top_k` items for `query`. Items scoring below `floor` may be left out (pruning bar)."""
+        return self._search(query, top_k, lang, floor)
+
+    def _search(self, query: str, top_k: int, lang: str | None, floor: float = 0.0) -> List[RetrievedChunk]:
+        if not self._n_live:
             return []
-        q_tokens = _tokenize(query)
-        q_set = set(q_tokens)
-        min_overlap = int(os.getenv("MIN_TOKEN_OVERLAP", "2"))
-        scored: List[RetrievedChunk] = []
-        q_is_ar = _is_arabic_text(query)
-        for it, toks in zip(self.items, self._docs_tokens):
-            # Optional language filter to avoid mixing AR/EN when not needed.
-            if lang in ("ar", "en"):
-                it_is_ar = _is_arabic_text(it.text)
-                if lang == "ar" and not it_is_ar:
+        min_overlap = min_token_overlap()
+        parts = self._partitions(lang)
+        terms, scales, bounds = self._query_terms(query, parts)
+        if min_overlap > 0 and top_k > 0 and sum(bounds.values()) < floor * _PRUNE_SLACK:
+            return []
+
+        # Term-at-a-time accumulation, highest-impact terms first. Once the remaining terms
+        # can no longer lift an unseen doc into the top-k (or past MIN_TOKEN_OVERLAP), stop
+        # admitting new docs and only probe the postings of the docs already in play.
+        acc: Dict[int, float] = {}
+        overlap: Dict[int, int] = {}
+        prune = min_overlap > 0 and top_k > 0
+        admit = True
+        rest = sum(bounds.values())
+        done = 0.0
+        for i, t in enumerate(terms):
+            if prune and admit and len(terms) - i < min_overlap:
+                admit = False
+            contrib_scale = scales[t]
+            for part in parts:
+                plist = self._postings[part].get(t)
+                if plist is None:
                     continue
-                if lang == "en" and it_is_ar:
+                ids, weights = plist
+                if admit:
+                    for doc_id, w in zip(ids, weights):
+                        acc[doc_id] = acc.get(doc_id, 0.0) + w * contrib_scale
+                        overlap[doc_id] = overlap.get(doc_id, 0) + 1
+                elif len(acc) * max(len(ids).bit_length(), 1) < len(ids):
+                    # Few live docs: binary-search them in the postings instead of a full walk.
+                    for doc_id in list(acc):
+                        j = bisect_left(ids, doc_id)
+                        if j < len(ids) and ids[j] == doc_id:
+                            acc[doc_id] += weights[j] * contrib_scale
+                            overlap[doc_id] += 1
+                else:
+                    for doc_id, w in zip(ids, weights):
+                        if doc_id in acc:
+                            acc[doc_id] += w * contrib_scale
+                            overlap[doc_id] += 1
+            rest -= bounds[t]
+            done += bounds[t]
+            # Partial scores are lower bounds of final scores, so the k-th best eligible one is
+            # a safe threshold. It can't exceed `done`, so only compute it once rest < done.
+            # Bounds are summed in another order than scores, so a doc tying the threshold could
+            # look a few ulps short of it: compare with a slightly lowered bar (ties keep KB order).
+            if prune and admit and i + 1 < len(terms):
+                theta = floor
+                if rest < done:
+                    top = self._top_unique(
+                        ((d, acc[d] / self._doc_norms[d]) for d, n in overlap.items() if n >= min_overlap), top_k
+                    )
+                    if len(top) >= top_k:
+                        theta = max(theta, top[-1][0])
+                theta *= _PRUNE_SLACK
+                if rest < theta:
+                    admit = False
+                    for d in [d for d, v in acc.items() if v / self._doc_norms[d] + rest < theta]:
+                        del acc[d]
+                        del overlap[d]
+
+        return self._rank(acc, overlap, parts, min_overlap, top_k)
+
+    def _query_terms(
+        self, query: str, parts: List[str]
+    ) -> Tuple[List[str], Dict[str, float], Dict[str, float]]:
+        """
+        Distinct indexed query terms, highest max-score bound first, with their weights
+        (occurrences * idf) and bounds (weight * max(w/norm) over their postings). Scores are
+        always summed in this order, so every path computes bit-identical similarities.
+        """
+        scales: Dict[str, float] = {}
+        for t in _tokenize(query):
+            if t in self._df:
+                scales[t] = scales.get(t, 0.0) + 1.0
+        bounds: Dict[str, float] = {}
+        for t, c in scales.items():
+            scales[t] = c * self._idf(t)
+            impact = max(self._max_impact[part].get(t, 0.0) for part in parts)
+            if impact > 0.0:
+                bounds[t] = scales[t] * impact
+        return sorted(bounds, key=bounds.__getitem__, reverse=True), scales, bounds
+
+    def search_batch(
+        self, queries: List[str], top_k: int = 4, lang: str | None = None
+    ) -> List[List[RetrievedChunk]]:
+        """
+        Search many queries: each distinct query is scored once with the pruned term-at-a-time
+        search (a shared, unpruned pass over the postings is slower than pruning each query).
+        """
+        results: Dict[str, List[RetrievedChunk]] = {}
+        for query in queries:
+            if query not in results:
+                results[query] = self._search(query, top_k, lang)
+        return [list(results[query]) for query in queries]
+
+    def score_items(
+        self, query: str, item_ids: Iterable[str], lang: str | None = None
+    ) -> Dict[str, RetrievedChunk]:
+        """
+        Exact similarity of the given items, as `search` would score them (best doc per id).
+        Items `search` would never return (other language, below MIN_TOKEN_OVERLAP) are left out.
+        """
+        min_overlap = min_token_overlap()
+        parts = self._partitions(lang)
+        terms, scales, _ = self._query_terms(query, parts)
+        out: Dict[str, RetrievedChunk] = {}
+        for item_id in item_ids:
+            for doc_id in self._id_docs.get(item_id, ()):
+                part = self._doc_lang[doc_id]
+                if part not in parts:
                     continue
-            # Filter out near-random matches: require at least N shared tokens (after stopword removal)
-            if min_overlap > 0:
-                overlap = len(q_set.intersection(toks))
-                if overlap < min_overlap:
+                score = 0.0
+                shared = 0
+                for t in terms:
+                    plist = self._postings[part].get(t)
+                    if plist is None:
+                        continue
+                    ids, weights = plist
+                    j = bisect_left(ids, doc_id)
+                    if j < len(ids) and ids[j] == doc_id:
+                        score += weights[j] * scales[t]
+                        shared += 1
+                if shared < min_overlap:
                     continue
-            scored.append(RetrievedChunk(item=it, similarity=self._score(q_tokens, toks)))
-        scored.sort(key=lambda x: x.similarity, reverse=True)
-        # De-duplicate by item.id so we don't show the same FAQ multiple times.
-        out: List[RetrievedChunk] = []
-        seen: set[str] = set()
-        for r in scored:
-            if r.item.id in seen:
-                continue
-            seen.add(r.item.id)
-            out.append(r)
-            if len(out) >= top_k:
-                break
+                sim = score / self._doc_norms[doc_id]
+                prev = out.get(item_id)
+                if prev is None or sim > prev.similarity:
+                    out[item_id] = RetrievedChunk(item=self._docs[doc_id], similarity=sim)
         return out
 
+    def _rank(
+        self,
+        acc: Dict[int, float],
+        overlap: Dict[int, int],
+        parts: List[str],
+        min_overlap: int,
+        top_k: int,
+    ) -> List[RetrievedChunk]:
+        # Filter out near-random matches: require at least N shared tokens (after stopword removal)
+        if min_overlap > 0:
+            candidates = (d for d, n in overlap.items() if n >= min_overlap)
+        else:
+            candidates = (d for part in parts for d in self._lang_docs[part])
+        # Normalize by doc length a bit to avoid bias towards long docs
+        scored = ((d, acc.get(d, 0.0) / self._doc_norms[d]) for d in candidates)
+        return [
+            RetrievedChunk(item=self._docs[-neg_doc], similarity=sim)
+            for sim, neg_doc, _ in self._top_unique(scored, top_k)
+        ]
 
+    def _top_unique(self, scored: Iterable[Tuple[int, float]], top_k: int) -> List[Tuple[float, int, str]]:
+        """
+        Bounded min-heap of the best `top_k` distinct item ids, best first.
+        Entries are (similarity, -doc_id, item.id): ties keep KB order. We de-duplicate by
+        item.id so we don't show the same FAQ multiple times.
+        """
+        heap: List[Tuple[float, int, str]] = []
+        in_heap: Dict[str, Tuple[float, int, str]] = {}
+        for doc_id, sim in scored:
+            entry = (sim, -doc_id, self._doc_ids[doc_id])
+            prev = in_heap.get(entry[2])
+            if prev is not None:
+                if entry > prev:
+                    heap.remove(prev)
+                    heap.append(entry)
+                    heapq.heapify(heap)
+                    in_heap[entry[2]] = entry
+            elif len(heap) < top_k:
+                heapq.heappush(heap, entry)
+                in_heap[entry[2]] = entry
+            elif heap and entry > heap[0]:
+                del in_heap[heapq.heapreplace(heap, entry)[2]]
+                in_heap[entry[2]] = entry
+        return sorted(heap, reverse=True)
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+class SingleFlight:
+    """
+    Request coalescing: concurrent calls with the same key share one execution and its result
+    (or exception). Sync callers coalesce across threads; async callers per event loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+        self._tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        self._stats = {"leaders": 0, "coalesced": 0}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+            self._stats["leaders" if leader else "coalesced"] += 1
+        if not leader:
+            return fut.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+        fut.set_result(result)
+        return result
+
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        # The shared work runs as its own task: a caller that disconnects (cancellation)
+        # doesn't cancel it for the others.
+        k = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            task = self._tasks.get(k)
+            leader = task is None
+            if leader:
+                task = asyncio.ensure_future(fn())
+                self._tasks[k] = task
+                task.add_done_callback(lambda _t: self._forget(k))
+            self._stats["leaders" if leader else "coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, k: Tuple[int, str]) -> None:
+        with self._lock:
+            self._tasks.pop(k, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"inFlight": len(self._calls) + len(self._tasks), **self._stats}
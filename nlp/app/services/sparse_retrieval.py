@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import math
+from typing import Dict, Iterable, List
+
+import numpy as np
+from scipy import sparse
+
+from app.services.knowledge_base import KBItem
+from app.services.retrieval import RetrievedChunk, _doc_lang, _tokenize, min_token_overlap
+
+
+class SparseRetriever:
+    """
+    Vectorized TF-IDF retriever (numpy + scipy), selected with RETRIEVER_ENGINE=sparse.
+    Same tokenizer, IDF formula and length normalization as the pure-Python Retriever,
+    but a query is scored with one sparse product over the rows of its tokens.
+    """
+
+    engine = "sparse"
+
+    def __init__(self, items: List[KBItem]):
+        self.items = items
+        self._vocab: Dict[str, int] = {}
+        # item.id -> doc ids (row positions), for score_items.
+        self._id_docs: Dict[str, List[int]] = {}
+        for doc_id, it in enumerate(items):
+            self._id_docs.setdefault(it.id, []).append(doc_id)
+        n = len(items)
+        rows: List[int] = []
+        cols: List[int] = []
+        vals: List[float] = []
+        for doc_id, it in enumerate(items):
+            toks = _tokenize(it.text)
+            doc_tf: Dict[str, int] = {}
+            for t in toks:
+                doc_tf[t] = doc_tf.get(t, 0) + 1
+            norm = math.sqrt(len(toks) + 1)
+            for t, tf in doc_tf.items():
+                rows.append(self._vocab.setdefault(t, len(self._vocab)))
+                cols.append(doc_id)
+                vals.append((1.0 + math.log(tf)) / norm)
+        # Term-major CSR (vocab x docs): slicing the query's rows yields exactly its postings.
+        self._matrix = sparse.csr_matrix(
+            (np.asarray(vals, dtype=np.float64), (np.asarray(rows, dtype=np.int32), np.asarray(cols, dtype=np.int32))),
+            shape=(len(self._vocab), n),
+        )
+        self._matrix.sort_indices()
+        # Same sparsity structure with 1s (sharing the index arrays): per-doc shared-token counts in search_batch.
+        self._pattern = sparse.csr_matrix(
+            (np.ones(self._matrix.nnz, dtype=np.int8), self._matrix.indices, self._matrix.indptr),
+            shape=self._matrix.shape,
+            copy=False,
+        )
+        df = np.diff(self._matrix.indptr)
+        self._idf = np.log((max(n, 1) + 1) / (df + 1)) + 1.0
+        self._is_ar = np.asarray([_doc_lang(it.text) == "ar" for it in items], dtype=bool)
+
+    def _query_vector(self, q_tokens: List[str]) -> tuple[np.ndarray, np.ndarray]:
+        # Repeated query tokens count once per occurrence, like the pure-Python scorer.
+        counts: Dict[int, int] = {}
+        for t in q_tokens:
+            col = self._vocab.get(t)
+            if col is not None:
+                counts[col] = counts.get(col, 0) + 1
+        term_ids = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+        q_weights = np.fromiter(counts.values(), dtype=np.float64, count=len(counts)) * self._idf[term_ids]
+        return term_ids, q_weights
+
+    def _lang_mask(self, lang: str | None) -> np.ndarray | None:
+        if lang == "ar":
+            return self._is_ar
+        if lang == "en":
+            return ~self._is_ar
+        return None
+
+    def search(
+        self, query: str, top_k: int = 4, lang: str | None = None, floor: float = 0.0
+    ) -> List[RetrievedChunk]:
+        # `floor` is a pruning hint for the Python engine; a full product has nothing to skip.
+        if not self.items:
+            return []
+        term_ids, q_weights = self._query_vector(_tokenize(query))
+        sub = self._matrix[term_ids]
+        scores = sub.T @ q_weights
+        # Distinct shared tokens per doc = how many of the query rows contain it.
+        overlap = np.bincount(sub.indices, minlength=len(self.items))
+        return self._rank(scores, overlap, lang, min_token_overlap(), top_k)
+
+    def search_batch(
+        self, queries: List[str], top_k: int = 4, lang: str | None = None
+    ) -> List[List[RetrievedChunk]]:
+        """
+        Score many queries with a single sparse product: (queries x vocab) @ (vocab x docs).
+        """
+        if not self.items or not queries:
+            return [[] for _ in queries]
+        rows: List[int] = []
+        cols: List[int] = []
+        vals: List[float] = []
+        for qi, query in enumerate(queries):
+            term_ids, q_weights = self._query_vector(_tokenize(query))
+            rows.extend([qi] * len(term_ids))
+            cols.extend(term_ids.tolist())
+            vals.extend(q_weights.tolist())
+        shape = (len(queries), self._matrix.shape[0])
+        q_matrix = sparse.csr_matrix((vals, (rows, cols)), shape=shape)
+        q_binary = sparse.csr_matrix((np.ones(len(vals), dtype=np.int32), (rows, cols)), shape=shape)
+        scores = (q_matrix @ self._matrix).tocsr()
+        overlaps = (q_binary @ self._pattern).tocsr()
+        min_overlap = min_token_overlap()
+        return [
+            self._rank(
+                scores[qi].toarray().ravel(),
+                overlaps[qi].toarray().ravel(),
+                lang,
+                min_overlap,
+                top_k,
+            )
+            for qi in range(len(queries))
+        ]
+
+    def score_items(
+        self, query: str, item_ids: Iterable[str], lang: str | None = None
+    ) -> Dict[str, RetrievedChunk]:
+        """Exact similarity of the given items, as `search` would score them (best doc per id)."""
+        docs = [d for item_id in item_ids for d in self._id_docs.get(item_id, ())]
+        mask = self._lang_mask(lang)
+        if mask is not None:
+            docs = [d for d in docs if mask[d]]
+        if not docs:
+            return {}
+        term_ids, q_weights = self._query_vector(_tokenize(query))
+        sub = self._matrix[term_ids][:, docs].tocsc()
+        scores = sub.T @ q_weights
+        overlap = np.diff(sub.indptr)
+        min_overlap = min_token_overlap()
+        out: Dict[str, RetrievedChunk] = {}
+        for pos, d in enumerate(docs):
+            if overlap[pos] < min_overlap:
+                continue
+            it = self.items[d]
+            prev = out.get(it.id)
+            if prev is None or scores[pos] > prev.similarity:
+                out[it.id] = RetrievedChunk(item=it, similarity=float(scores[pos]))
+        return out
+
+    def _rank(
+        self, scores: np.ndarray, overlap: np.ndarray, lang: str | None, min_overlap: int, top_k: int
+    ) -> List[RetrievedChunk]:
+        if min_overlap > 0:
+            eligible = overlap >= min_overlap
+        else:
+            eligible = np.ones(len(self.items), dtype=bool)
+        mask = self._lang_mask(lang)
+        if mask is not None:
+            eligible &= mask
+        return self._top_unique(np.flatnonzero(eligible), scores, top_k)
+
+    def _top_unique(self, cand: np.ndarray, scores: np.ndarray, top_k: int) -> List[RetrievedChunk]:
+        if top_k <= 0 or not len(cand):
+            return []
+        cand_scores = scores[cand]
+        m = top_k
+        while True:
+            if m < len(cand):
+                # argpartition for the m best, then widen to every doc tied with the m-th
+                # score so ties are broken by KB order exactly like the Python engine.
+                kth = cand_scores[np.argpartition(-cand_scores, m - 1)[:m]].min()
+                sel = cand[cand_scores >= kth]
+            else:
+                sel = cand
+            sel = sel[np.lexsort((sel, -scores[sel]))]
+            # De-duplicate by item.id so we don't show the same FAQ multiple times.
+            out: List[RetrievedChunk] = []
+            seen: set[str] = set()
+            for doc_id in sel:
+                it = self.items[int(doc_id)]
+                if it.id in seen:
+                    continue
+                seen.add(it.id)
+                out.append(RetrievedChunk(item=it, similarity=float(scores[doc_id])))
+                if len(out) >= top_k:
+                    return out
+            if len(sel) == len(cand):
+                return out
+            m *= 2
@@ -0,0 +1,47 @@
+import os
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from app.services.knowledge_base import load_kb
+from app.services.retrieval import QuestionFusionRetriever, Retriever
+
+DATA_DIR = Path(__file__).resolve().parents[2] / "data"
+
+
+class PrunedSearchTiesTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {"MIN_TOKEN_OVERLAP": "1", "KB_FILENAME": "kb_backup.jsonl"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.retriever = Retriever(load_kb(str(DATA_DIR)))
+
+    def test_tied_scores_keep_kb_order_at_every_k(self):
+        # Several entries score exactly the same for this query; pruning must not drop the first one.
+        query = "البريد لإعادة وقدّم"
+        full = self.retriever.search(query, top_k=len(self.retriever.items))
+        self.assertGreater(len(full), 1)
+        self.assertEqual(full[0].similarity, full[1].similarity)
+        for k in range(1, 8):
+            got = [c.item.id for c in self.retriever.search(query, top_k=k)]
+            self.assertEqual(got, [c.item.id for c in full[:k]], f"top_k={k}")
+
+
+class QuestionFusionTiesTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {"RETRIEVAL_QUESTION_WEIGHT": "0.5", "KB_FILENAME": "kb_backup.jsonl"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.retriever = QuestionFusionRetriever(load_kb(str(DATA_DIR)))
+
+    def test_top_k_is_a_prefix_of_the_full_ranking(self):
+        # Duplicate entries tie on the fused score; they must come back in KB order whatever k is.
+        query = "كيف أدفع رسوم التسجيل؟"
+        full = self.retriever.search(query, top_k=len(self.retriever.items))
+        for k in range(1, 11):
+            got = [c.item.id for c in self.retriever.search(query, top_k=k)]
+            self.assertEqual(got, [c.item.id for c in full[:k]], f"top_k={k}")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Build the on-disk retrieval index for a KB jsonl file.
+
+Every uvicorn worker can then mmap the same file (shared page cache) instead of
+re-tokenizing the KB at startup. The index records the KB file size/mtime and is
+ignored automatically once the KB changes, so re-run this after editing the KB.
+
+Usage (Windows CMD):
+  cd NLP-project
+  python nlp\\tools\\build_index.py data\\kb_backup.jsonl
+  set KB_INDEX=kb_backup.idx
+
+Multi-worker deployments can instead prebuild the shared index once from the parent
+(e.g. before `gunicorn`/`uvicorn --workers N`) and run the workers with KB_SHARED_INDEX=1:
+  python nlp/tools/build_index.py data/kb_backup.jsonl --shared
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.services.retrieval import build_index_file, shared_index_path  # noqa: E402
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("path", nargs="?", default="data/kb_backup.jsonl", help="Path to the KB jsonl")
+    p.add_argument("--out", default="", help="Index path (default: same name with .idx)")
+    p.add_argument("--shared", action="store_true", help="Write the shared index used by KB_SHARED_INDEX=1")
+    args = p.parse_args()
+
+    path = Path(args.path)
+    if not path.exists():
+        raise SystemExit(f"File not found: {path}")
+    if args.shared:
+        out = Path(shared_index_path(str(path)))
+    else:
+        out = Path(args.out) if args.out else path.with_suffix(".idx")
+
+    started = time.perf_counter()
+    docs = build_index_file(str(path), str(out))
+
+    print("kb:", str(path))
+    print("index:", str(out))
+    print("docs:", docs)
+    print("bytes:", out.stat().st_size)
+    print("seconds:", round(time.perf_counter() - started, 3))
+
+
+if __name__ == "__main__":
+    main()